@@ -0,0 +1,205 @@
+##############################################################################
+#
+# Library:   TubeTK
+#
+# Copyright 2010 Kitware Inc. 28 Corporate Drive,
+# Clifton Park, NY, 12065, USA.
+#
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+
+"""Tests for the spImageFilters module.
+
+The vectorized filters are compared with the original pixel loops
+(reference_* below) on fixed random images, including the behavior the
+loops had at the edges: the seed membership of floodfill, the
+integer-division region weights of removeSmallSizes and
+getLargestRegionBlob, and the mask of the final iteration of
+thresholdBinary.
+"""
+
+import os
+import sys
+
+import numpy as np
+import scipy as sp
+import scipy.ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import spImageFilters
+
+_4_connected = np.array([[0, 1, 0],
+                         [1, 1, 1],
+                         [0, 1, 0]], dtype=bool)
+
+_8_connected = np.ones((3, 3), dtype=bool)
+
+
+def reference_floodfill(inputImage, seed, threshMin, threshMax):
+    # Original breadth-first fill; unlike the original, neighbors with
+    # negative indices are skipped instead of wrapping around
+    x, y = seed
+    mask = np.zeros(inputImage.shape, dtype=bool)
+    roi = [(x, y)]
+    edge = [(x, y)]
+    while edge:
+        newedge = []
+        for (x, y) in edge:
+            for (s, t) in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if not (0 <= s < inputImage.shape[0] and
+                        0 <= t < inputImage.shape[1]):
+                    continue
+                item = inputImage[s, t]
+                if item >= threshMin and item <= threshMax and not mask[s, t]:
+                    mask[s, t] = True
+                    newedge.append((s, t))
+                    if not (s, t) in roi:
+                        roi.append((s, t))
+        edge = newedge
+    return mask, roi
+
+
+def reference_removeSmallSizes(inputImage, minSize, structure=_4_connected):
+    labelImage, num_objects = sp.ndimage.label(inputImage, structure)
+    objectLabels = np.arange(1, num_objects + 1)
+    if inputImage.max() == 0:
+        return inputImage
+    areas = np.array(sp.ndimage.sum(inputImage / inputImage.max(),
+                                    labelImage, objectLabels))
+    bigObjectImage = np.zeros(inputImage.shape, dtype=bool)
+    for bo in objectLabels[areas >= minSize]:
+        bigObjectImage |= labelImage == bo
+    return bigObjectImage
+
+
+def reference_getLargestRegionBlob(inputImage):
+    labelImage, num_objects = sp.ndimage.label(inputImage)
+    objectLabels = np.arange(1, num_objects + 1)
+    if inputImage.max() == 0:
+        return inputImage
+    areas = np.array(sp.ndimage.sum(inputImage / inputImage.max(),
+                                    labelImage, objectLabels))
+    max_size = sp.ndimage.maximum(areas)
+    bigObjectImage = np.zeros(inputImage.shape, dtype=bool)
+    for bo in objectLabels[areas == max_size]:
+        bigObjectImage |= labelImage == bo
+    return bigObjectImage
+
+
+def reference_thresholdBinary(x, T, delta=1e-3, minval=1, maxval=0):
+    x = np.asarray(x).copy()
+    Told = T + 1
+    while np.abs(T - Told) > delta:
+        Told = T
+        mask = (x <= T)
+        T = (x[mask].mean() + x[~mask].mean()) / 2.
+    x[mask] = minval
+    x[~mask] = maxval
+    return x, T
+
+
+def FloodfillTest():
+    rng = np.random.RandomState(0)
+    passed = True
+    for k in range(20):
+        image = rng.randint(0, 4, (24, 32))
+        # Include seeds on the border and seeds that are out of range
+        seed = (rng.randint(0, 24), rng.randint(0, 32))
+        if k % 4 == 0:
+            seed = (0, rng.randint(0, 32))
+        mask, roi = spImageFilters.floodfill(image, seed, 1, 2,
+                                             return_region=True)
+        baseline, baseline_roi = reference_floodfill(image, seed, 1, 2)
+        if not np.array_equal(mask, baseline):
+            print('floodfill mask differs for seed ' + str(seed))
+            passed = False
+        if roi[0] != tuple(seed) or set(roi) != set(baseline_roi):
+            print('floodfill region differs for seed ' + str(seed))
+            passed = False
+    return passed
+
+
+def RemoveSmallSizesTest():
+    rng = np.random.RandomState(1)
+    passed = True
+    for k in range(10):
+        # Binary and multi-valued (integer-division weights) images
+        binary = rng.rand(40, 50) < 0.45
+        labeled = binary * rng.randint(1, 4, binary.shape)
+        for image in (binary, labeled):
+            for structure in (_4_connected, _8_connected):
+                result = spImageFilters.removeSmallSizes(image, 4, structure)
+                baseline = reference_removeSmallSizes(image, 4, structure)
+                if not np.array_equal(result, baseline):
+                    print('removeSmallSizes differs for ' + str(image.dtype))
+                    passed = False
+            result = spImageFilters.getLargestRegionBlob(image)
+            baseline = reference_getLargestRegionBlob(image)
+            if not np.array_equal(result, baseline):
+                print('getLargestRegionBlob differs for ' + str(image.dtype))
+                passed = False
+    return passed
+
+
+def ThresholdBinaryTest():
+    rng = np.random.RandomState(2)
+    passed = True
+    for k in range(10):
+        # Bimodal integer images (one histogram bin per value)
+        image = np.concatenate((rng.normal(60, 15, 500),
+                                rng.normal(170, 25, 300)))
+        image = np.clip(image, 0, 255).astype(np.uint8).reshape(20, 40)
+        T0 = rng.uniform(80, 200)
+        # A coarse delta leaves pixels between the last two thresholds
+        for delta in (1e-3, 0.5):
+            result, T = spImageFilters.thresholdBinary(image, T0, delta)
+            baseline, baseline_T = reference_thresholdBinary(image, T0,
+                                                             delta)
+            if not np.array_equal(result, baseline) or T != baseline_T:
+                print('thresholdBinary differs for T0 = ' + str(T0))
+                passed = False
+        # Float images in exact mode
+        image = image + rng.rand(*image.shape)
+        result, T = spImageFilters.thresholdBinary(image, T0, exact=True)
+        baseline, baseline_T = reference_thresholdBinary(image, T0)
+        if (not np.array_equal(result, baseline) or
+                not np.allclose(T, baseline_T)):
+            print('thresholdBinary (exact) differs for T0 = ' + str(T0))
+            passed = False
+    return passed
+
+if __name__ == '__main__':
+    usage = 'Usage: ' + sys.argv[0] + \
+            ' <TestName> [TestArg1 TestArg2 ...  TestArgN]'
+    if len(sys.argv) < 2:
+        print(usage)
+        sys.exit(1)
+
+    test_to_call = locals()[sys.argv[1]]
+    # Pass arguments without an '=' as args.
+
+    args = [arg for arg in sys.argv[2:] if arg.find('=') == -1]
+    args = tuple(args)
+    # Pass arguments with an '=' as kwargs.
+    kwargs = [arg.split('=') for arg in sys.argv[2:] if arg.find('=') != -1]
+    kwargs = dict(kwargs)
+
+    if not test_to_call(*args, **kwargs):
+        sys.exit(1)
+    else:
+        sys.exit(0)
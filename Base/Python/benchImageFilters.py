@@ -0,0 +1,268 @@
+##############################################################################
+#
+# Library:   TubeTK
+#
+# Copyright 2010 Kitware Inc. 28 Corporate Drive,
+# Clifton Park, NY, 12065, USA.
+#
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+##############################################################################
+#!/usr/bin/env python
+
+"""
+    Benchmark and compare the Gaussian filters of spImageFilters (scipy)
+    and cvImageFilters (OpenCV) on 2D images and 3D (frames, H, W) stacks
+
+    For each size, dtype and kernel size, both backends are timed, their
+    results are compared on the image interior (the backends use different
+    border modes and kernel truncations) and the faster backend whose
+    results agree is recommended. Results are written as JSON; other code
+    can pick the backend from such a report with selectBackend, or filter
+    with the selected backend by gaussianFilter.
+
+    Example:
+
+        python benchImageFilters.py --sizes 512x512,64x480x640 --out bench.json
+"""
+
+from optparse import OptionParser
+import platform
+import logging
+import json
+import time
+import sys
+
+import numpy as np
+
+import scipy as sp
+import scipy.ndimage
+
+import spImageFilters
+try:
+    import cvImageFilters
+except ImportError:
+    # OpenCV is not available, only benchmark scipy
+    cvImageFilters = None
+
+
+def openCVSigma( filterSize ):
+    """
+        Sigma that OpenCV derives from the kernel size (if sigma is 0)
+        For filterSize <= 7, OpenCV uses fixed kernels instead, e.g.,
+        [1, 2, 1] / 4; for these, the sigma of that kernel is returned
+    """
+    fixedKernelSigma = { 1 : 0.0, 3 : np.sqrt( 0.5 ), 5 : 1.0,
+                         7 : np.sqrt( 1.875 ) }
+    if filterSize in fixedKernelSigma:
+        return fixedKernelSigma[filterSize]
+    return 0.3 * ( ( filterSize - 1 ) * 0.5 - 1 ) + 0.8
+
+def spGaussian( image, filterSize ):
+    sigma = openCVSigma( filterSize )
+    if image.ndim == 3:
+        smoothed, tmp = spImageFilters.gaussianFilterFrames( image, sigma,
+            want_highpass=False, dtype=np.float32 )
+    else:
+        smoothed, tmp = spImageFilters.gaussianFilter( image, sigma,
+            want_highpass=False, dtype=np.float32 )
+    return smoothed
+
+def cvGaussian( image, filterSize, nThreads=None ):
+    if image.ndim == 3:
+        return cvImageFilters.gaussianFilterFrames( image, filterSize,
+            nThreads=nThreads )
+    return cvImageFilters.gaussianFilter( image, filterSize )
+
+def timeCall( repeat, fun, *args ):
+    """
+        Returns the result of fun( *args ) and the min. time of repeat calls
+    """
+    times = []
+    for i in range( repeat ):
+        t0 = time.time()
+        result = fun( *args )
+        times.append( time.time() - t0 )
+    return result, min( times )
+
+def interior( image, margin ):
+    """
+        Image without a border of margin pixels in each frame
+    """
+    frame = ( slice( margin, -margin or None ), ) * 2
+    return image[( Ellipsis, ) + frame]
+
+def randomImage( shape, dtype, rng ):
+    """
+        Random image with structures of a few pixels (rather than white
+        noise) in [0, 255]
+    """
+    image = rng.rand( *shape )
+    sigma = ( 0, 2, 2 ) if len( shape ) == 3 else 2
+    image = sp.ndimage.gaussian_filter( image, sigma )
+    image = spImageFilters.normalize( image ) * 255
+    return image.astype( dtype )
+
+def benchmark( options ):
+    """
+        Runs the benchmark for all sizes, dtypes and kernel sizes and
+        returns one record per case
+    """
+    logger = logging.getLogger()
+    rng = np.random.RandomState( options.seed )
+
+    results = []
+    for shape in options.sizes:
+        for dtype in options.dtypes:
+            image = randomImage( shape, dtype, rng )
+            for filterSize in options.filterSizes:
+                sigma = openCVSigma( filterSize )
+                record = { 'shape' : list( shape ),
+                           'dtype' : dtype,
+                           'filterSize' : filterSize,
+                           'sigma' : sigma }
+
+                spResult, spTime = timeCall( options.repeat, spGaussian,
+                    image, filterSize )
+                record['sp_seconds'] = spTime
+                record['sp_mpixPerSec'] = image.size / spTime / 1e6
+
+                if cvImageFilters is None:
+                    record['recommended'] = 'sp'
+                    results.append( record )
+                    continue
+
+                cvResult, cvTime = timeCall( options.repeat, cvGaussian,
+                    image, filterSize, options.threads )
+                record['cv_seconds'] = cvTime
+                record['cv_mpixPerSec'] = image.size / cvTime / 1e6
+
+                # Compare beyond the support of both kernels
+                margin = max( ( filterSize - 1 ) // 2,
+                              spImageFilters._gaussianRadius( sigma ) )
+                diff = np.abs( interior( spResult, margin ).astype( float ) -
+                    interior( cvResult, margin ) )
+                maxDiff = float( diff.max() ) if diff.size else 0.0
+                record['maxAbsDiff'] = maxDiff
+                record['agree'] = maxDiff <= options.tolerance * 255
+
+                if record['agree'] and cvTime < spTime:
+                    record['recommended'] = 'cv'
+                else:
+                    record['recommended'] = 'sp'
+
+                logger.info( "%s %s k=%d : sp %.1f, cv %.1f [Mpix/s], "
+                    "max. diff. %.3g -> %s" % ( 'x'.join( map( str, shape ) ),
+                    dtype, filterSize, record['sp_mpixPerSec'],
+                    record['cv_mpixPerSec'], maxDiff,
+                    record['recommended'] ) )
+                results.append( record )
+    return results
+
+def recommendBackends( results ):
+    """
+        Backend recommended for most cases of each (2D/3D, dtype) pair
+    """
+    votes = {}
+    for record in results:
+        key = "%dD %s" % ( len( record['shape'] ), record['dtype'] )
+        votes.setdefault( key, [] ).append( record['recommended'] )
+    return dict( ( key, max( set( v ), key=v.count ) )
+        for key, v in votes.items() )
+
+def selectBackend( recommended, shape, dtype ):
+    """
+        Backend ('sp' or 'cv') for images of shape and dtype, given the
+        'recommended' entry of a benchmark report (see loadRecommended);
+        'sp' if there is no recommendation or OpenCV is not available
+    """
+    if cvImageFilters is None or recommended is None:
+        return 'sp'
+    key = "%dD %s" % ( len( shape ), np.dtype( dtype ).name )
+    return recommended.get( key, 'sp' )
+
+def loadRecommended( filename ):
+    """
+        Reads the backend recommendations of a benchmark report
+    """
+    with open( filename ) as fid:
+        return json.load( fid )['recommended']
+
+def gaussianFilter( image, filterSize, recommended=None, nThreads=None ):
+    """
+        Gaussian filter (OpenCV kernel size, float32 result) of a 2D image
+        or (frames, H, W) stack, computed by the backend that selectBackend
+        picks for it
+    """
+    image = np.asarray( image )
+    if selectBackend( recommended, image.shape, image.dtype ) == 'cv':
+        return cvGaussian( image, filterSize, nThreads )
+    return spGaussian( image, filterSize )
+
+def main( argv=None ):
+    if argv is None:
+        argv = sys.argv
+
+    parser = OptionParser()
+    parser.add_option( "", "--sizes",
+        default="256x256,512x512,1024x1024,16x480x640",
+        help="list of image sizes (HxW or FRAMESxHxW), e.g., 512x512" )
+    parser.add_option( "", "--dtypes",
+        default="uint8,float32,float64",
+        help="list of image types." )
+    parser.add_option( "", "--filterSizes",
+        default="5,15,31",
+        help="list of (odd) OpenCV kernel sizes." )
+    parser.add_option( "", "--tolerance",
+        default=0.01, type="float",
+        help="max. interior difference (relative to 255) to agree." )
+    parser.add_option( "", "--threads",
+        type="int",
+        help="number of threads for stacks (default: #CPUs)." )
+    parser.add_option( "", "--repeat",
+        default=3, type="int",
+        help="number of repetitions per case (min. time)." )
+    parser.add_option( "", "--seed",
+        default=0, type="int",
+        help="seed for the random images." )
+    parser.add_option( "", "--out",
+        help="JSON output file (default: stdout)." )
+    ( options, args ) = parser.parse_args( argv[1:] )
+
+    options.sizes = [ tuple( int( n ) for n in e.split( 'x' ) )
+        for e in options.sizes.split( ',' ) ]
+    options.dtypes = options.dtypes.split( ',' )
+    options.filterSizes = [ int( e ) for e in options.filterSizes.split( ',' ) ]
+
+    logging.basicConfig( level=logging.INFO, format='%(message)s' )
+
+    report = { 'python' : platform.python_version(),
+               'platform' : platform.platform(),
+               'numpy' : np.__version__,
+               'date' : time.strftime( '%Y-%m-%d %H:%M:%S' ),
+               'options' : vars( options ),
+               'results' : benchmark( options ) }
+    report['recommended'] = recommendBackends( report['results'] )
+    if cvImageFilters is not None:
+        report['opencv'] = cvImageFilters.cv2.__version__
+
+    if options.out is None:
+        sys.stdout.write( json.dumps( report, indent=2 ) + "\n" )
+    else:
+        with open( options.out, 'w' ) as fid:
+            json.dump( report, fid, indent=2 )
+
+if __name__ == "__main__":
+    main()
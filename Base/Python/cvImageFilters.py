@@ -22,94 +22,157 @@
 ##############################################################################
 #!/usr/bin/env python
 
-import Image
+try:
+    import Image
+except ImportError:
+    from PIL import Image
 
 import cv2
-import cv2.cv as cv
+try:
+    import cv2.cv as cv
+except ImportError:
+    # OpenCV >= 3 has no legacy cv module (and no IplImage); all functions
+    # below work on numpy arrays, which cv2 uses without copying
+    cv = None
 import numpy as np
 
+from multiprocessing.pool import ThreadPool
+
 def cv2array(im):
   '''
-    Copied from http://opencv.willowgarage.com/wiki/PythonInterface
+    Convert an image to a numpy array. Arrays are returned as is, legacy
+    IplImage/CvMat images are wrapped without copying the data
   '''
-  depth2dtype = {
-        cv.IPL_DEPTH_8U: 'uint8',
-        cv.IPL_DEPTH_8S: 'int8',
-        cv.IPL_DEPTH_16U: 'uint16',
-        cv.IPL_DEPTH_16S: 'int16',
-        cv.IPL_DEPTH_32S: 'int32',
-        cv.IPL_DEPTH_32F: 'float32',
-        cv.IPL_DEPTH_64F: 'float64',
-    }
-
-  arrdtype=im.depth
-  a = np.fromstring(
-         im.tostring(),
-         dtype=depth2dtype[im.depth],
-         count=im.width*im.height*im.nChannels)
-  if im.nChannels is not 1:
-    a.shape = (im.height,im.width,im.nChannels)
-  else:
-    a.shape = (im.height,im.width)
-  return a
+  if isinstance(im, np.ndarray):
+    return im
+  return np.asarray(cv.GetMat(im))
+
+def _isLegacyImage(im):
+  return cv is not None and not isinstance(im, np.ndarray)
+
+def _toLegacyImage(a):
+  # IplImage header on the data of a (no copy)
+  return cv.GetImage(cv.fromarray(a))
 
 def array2cv(a):
   '''
-    Copied from http://opencv.willowgarage.com/wiki/PythonInterface
+    Convert a numpy array to an image, sharing the data of a C-contiguous
+    copy of a (only copied if needed; bool arrays are viewed as 8-bit
+    images). The image is an IplImage if the legacy cv module is available
+    (as before) or else the array itself, as used by cv2
   '''
-  dtype2depth = {
-        'bool':   cv.IPL_DEPTH_8U,
-        'uint8':   cv.IPL_DEPTH_8U,
-        'int8':    cv.IPL_DEPTH_8S,
-        'uint16':  cv.IPL_DEPTH_16U,
-        'int16':   cv.IPL_DEPTH_16S,
-        'int32':   cv.IPL_DEPTH_32S,
-        'float32': cv.IPL_DEPTH_32F,
-        'float64': cv.IPL_DEPTH_64F,
-    }
-  try:
-    nChannels = a.shape[2]
-  except:
-    nChannels = 1
-  cv_im = cv.CreateImageHeader((a.shape[1],a.shape[0]),
-          dtype2depth[str(a.dtype)],
-          nChannels)
-  cv.SetData(cv_im, a.tostring(),
-             a.dtype.itemsize*nChannels*a.shape[1])
-  return cv_im
+  a = np.ascontiguousarray(a)
+  if a.dtype == bool:
+    a = a.view(np.uint8)
+  if cv is not None:
+    return _toLegacyImage(a)
+  return a
 
 def cv2Image(cv_im):
-  pi = Image.fromstring( "L", cv.GetSize(cv_im), cv_im.tostring() )
+  pi = Image.fromarray( cv2array(cv_im) )
   return pi
 
 def Image2cv(pi):
-  cv_im = cv.CreateImageHeader( pi.size, cv.IPL_DEPTH_8U, 1 )
-  cv.SetData( cv_im, pi.tostring() )
+  cv_im = np.asarray( pi )
+  if cv is not None:
+    return _toLegacyImage( np.ascontiguousarray( cv_im ) )
   return cv_im
 
 
-def gaussianFilter( inputImage, filterSize ):
+def gaussianFilter( inputImage, filterSize, out=None ):
     """
         Apply Gaussian filter of OpenCV to a given array
+        (filterSize x filterSize kernel, replicated border as cv.Smooth).
+        The float32 result is written to out, if given, or else returned
+        as an array (IplImage for legacy IplImage/CvMat input)
     """
-    # Convert from numpy array  to CvMat
-    outputImage = cv.CreateImage( cv.GetSize( inputImage ), cv.IPL_DEPTH_32F, 1 )
+    if out is None:
+        outputImage = cv2.GaussianBlur(
+            np.asarray( cv2array( inputImage ), dtype=np.float32 ),
+            ( filterSize, filterSize ), 0, borderType=cv2.BORDER_REPLICATE )
+        if _isLegacyImage( inputImage ):
+            return _toLegacyImage( outputImage )
+        return outputImage
 
-    cv.Smooth( inputImage, outputImage, cv.CV_GAUSSIAN, filterSize, filterSize )
+    # Filter in place, after converting the input into out
+    out[...] = cv2array( inputImage )
+    cv2.GaussianBlur( out, ( filterSize, filterSize ), 0, dst=out,
+                      borderType=cv2.BORDER_REPLICATE )
 
-    return outputImage
+    return out
 
 
-def adaptiveThresholding( inputImage, neighborhoodWidth=71, offsetFromMean=15 ):
+def adaptiveThresholding( inputImage, neighborhoodWidth=71, offsetFromMean=15,
+                          out=None ):
     """
         Apply adaptive thresholding to a given image.  Uses a
          neighborhoodWidth x neighborhoodWidth kernel.   Threshold is set at
-         mean intensity within kernel + offsetFromMean.
+         mean intensity within kernel + offsetFromMean.  The (uint8)
+         result is written to out, if given, or else returned as an array
+         (IplImage for legacy IplImage/CvMat input).
     """
-    outputImage = cv.CreateImage( cv.GetSize( inputImage ), cv.IPL_DEPTH_8U, 1 )
-
-    cv.AdaptiveThreshold( inputImage, outputImage, 255, cv.CV_THRESH_BINARY,
-                          cv.CV_ADAPTIVE_THRESH_MEAN_C, neighborhoodWidth,
-                          offsetFromMean )
+    outputImage = cv2.adaptiveThreshold( cv2array( inputImage ), 255,
+                                         cv2.ADAPTIVE_THRESH_MEAN_C,
+                                         cv2.THRESH_BINARY, neighborhoodWidth,
+                                         offsetFromMean, dst=out )
 
+    if out is None and _isLegacyImage( inputImage ):
+        return _toLegacyImage( outputImage )
     return outputImage
+
+
+def _mapFrames( fun, nFrames, nThreads ):
+    """
+        Calls fun( i ) for all frames i, in a pool of nThreads threads
+        (default: #CPUs); OpenCV releases the GIL while filtering
+    """
+    if nThreads is None:
+        nThreads = cv2.getNumberOfCPUs()
+    if nThreads > 1 and nFrames > 1:
+        pool = ThreadPool( min( nThreads, nFrames ) )
+        try:
+            pool.map( fun, range( nFrames ) )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i in range( nFrames ):
+            fun( i )
+
+
+def gaussianFilterFrames( frames, filterSize, out=None, nThreads=None ):
+    """
+        Apply gaussianFilter to each frame of a (frames, H, W) stack (or a
+        list of frames). The results are written to out, a preallocated
+        float32 stack that is allocated if None
+    """
+    if out is None:
+        out = np.empty( ( len( frames ), ) + np.shape( frames[0] ),
+                        dtype=np.float32 )
+
+    def filterFrame( i ):
+        gaussianFilter( frames[i], filterSize, out=out[i] )
+
+    _mapFrames( filterFrame, len( frames ), nThreads )
+
+    return out
+
+
+def adaptiveThresholdingFrames( frames, neighborhoodWidth=71,
+                                offsetFromMean=15, out=None, nThreads=None ):
+    """
+        Apply adaptiveThresholding to each (uint8) frame of a
+        (frames, H, W) stack (or a list of frames). The results are written
+        to out, a preallocated uint8 stack that is allocated if None
+    """
+    if out is None:
+        out = np.empty( ( len( frames ), ) + np.shape( frames[0] ),
+                        dtype=np.uint8 )
+
+    def thresholdFrame( i ):
+        adaptiveThresholding( frames[i], neighborhoodWidth, offsetFromMean,
+                              out=out[i] )
+
+    _mapFrames( thresholdFrame, len( frames ), nThreads )
+
+    return out
@@ -0,0 +1,384 @@
+"""bench.py
+
+Benchmark the pyfsa pipeline stages (feature extraction, codebook
+learning and GMM scoring) on synthetic tube-like graphs of growing
+size. Results are written as JSON, one record per (stage, size,
+radius), so that scaling curves can be compared between releases.
+
+Example:
+
+    python bench.py --sizes 100,200,400 --radii 1,2 --out bench.json
+"""
+
+__license__ = "Apache License, Version 2.0 (see TubeTK)"
+__author__  = "Roland Kwitt, Kitware Inc., 2013"
+__email__   = "E-Mail: roland.kwitt@kitware.com"
+__status__  = "Development"
+
+
+# Graph handling
+import networkx as nx
+
+# Misc.
+from optparse import OptionParser
+from multiprocessing import Pipe, Process
+import platform
+import traceback
+import tempfile
+import logging
+import shutil
+import json
+import numpy as np
+import time
+import sys
+import os
+
+# pyfsa imports
+import core.fsa as fsa
+import core.profiling as profiling
+import core.utils as utils
+
+
+def synthetic_graph(n, n_labels=4, loops=0.05, branching=0.2, seed=None):
+    """Generate a labeled, tube-like graph.
+
+    The graph is a random tree in which most vertices continue the
+    branch of their predecessor (i.e., long chains, as in vessel
+    trees), plus a number of random edges that close loops.
+
+    Parameters
+    ----------
+
+    n : int
+        Number of vertices.
+
+    n_labels : int (default : 4)
+        Size of the vertex label alphabet.
+
+    loops : float (default : 0.05)
+        Number of additional (loop-closing) edges, relative to n.
+
+    branching : float (default : 0.2)
+        Probability that a vertex starts a new branch at a random
+        earlier vertex instead of continuing the current one.
+
+    seed : int (default : None)
+        Seed for the random number generator.
+
+    Returns
+    -------
+
+    G : networkx Graph
+        Graph with vertex labels stored as 'type'.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    G = nx.Graph()
+    G.add_node(0)
+    for v in range(1, n):
+        if rng.rand() < branching:
+            G.add_edge(v, rng.randint(0, v))
+        else:
+            G.add_edge(v, v-1)
+
+    n_loops = int(round(loops * n))
+    while n_loops > 0 and n > 2:
+        u, v = rng.randint(0, n, 2)
+        if u != v and not G.has_edge(u, v):
+            G.add_edge(u, v)
+            n_loops -= 1
+
+    for v, l in enumerate(rng.randint(0, n_labels, n)):
+        G.node[v]['type'] = int(l)
+    return G
+
+
+def write_graph(G, base):
+    """Write a graph in the format read by 'fsa.graph_from_file'.
+
+    Parameters
+    ----------
+
+    G : networkx Graph
+        Graph with vertex labels stored as 'type'.
+
+    base : string
+        Base file name; writes '<base>.adj' and '<base>.lab'.
+
+    Returns
+    -------
+
+    files : 2-tuple of (graph file, label file)
+    """
+
+    graph_file, label_file = "%s.adj" % base, "%s.lab" % base
+    np.savetxt(graph_file, nx.to_numpy_matrix(G, nodelist=range(len(G))),
+               fmt="%d")
+    np.savetxt(label_file, [G.node[v]['type'] for v in range(len(G))],
+               fmt="%d")
+    return graph_file, label_file
+
+
+def _measure_child(conn, fun, args):
+    try:
+        # Current RSS (if available), otherwise the peak RSS so far
+        rss0 = profiling.rss_kb()
+        if rss0 is None:
+            rss0 = profiling.peak_rss_kb()
+        t0 = time.time()
+        res = fun(*args)
+        elapsed = time.time() - t0
+        peak = profiling.peak_rss_kb()
+        increase = None
+        if not peak is None and not rss0 is None:
+            increase = max(peak - rss0, 0)
+        conn.send((None, (res, elapsed, increase)))
+    except Exception as e:
+        # Pass the error (and traceback) on to the parent
+        try:
+            conn.send((e, traceback.format_exc()))
+        except Exception:
+            conn.send((RuntimeError(str(e)), traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def measure(fun, *args):
+    """Run a function in a child process and measure it.
+
+    Running each stage in its own (forked) process isolates the peak
+    memory measurement from the other stages.
+
+    Parameters
+    ----------
+
+    fun : callable
+        Function to benchmark; its result needs to be picklable.
+
+    args : arguments to 'fun'
+
+    Returns
+    -------
+
+    res : object
+        Result of 'fun(*args)'.
+
+    elapsed : float
+        Wall time (in seconds).
+
+    peak_kb : int
+        Peak increase of the resident set size (in KB); 'None' if
+        the RSS cannot be measured on this platform.
+    """
+
+    parent_conn, child_conn = Pipe(duplex=False)
+    p = Process(target=_measure_child, args=(child_conn, fun, args))
+    p.start()
+    # Only the child writes; otherwise recv() never sees EOF if it dies
+    child_conn.close()
+    try:
+        err, res = parent_conn.recv()
+    except EOFError:
+        err, res = None, None
+    finally:
+        parent_conn.close()
+        p.join()
+
+    if not err is None:
+        logging.getLogger().error("Stage failed:\n%s" % res)
+        raise err
+    if res is None or p.exitcode != 0:
+        raise RuntimeError("Benchmark process exited with code %s" %
+                           p.exitcode)
+    return res
+
+
+def _stage_graph_features(graphs, radius, features):
+    return [fsa.compute_graph_features(G, radius, None, False, features)
+            for G in graphs]
+
+
+def _stage_run_fsa(data, radius, features):
+    return fsa.run_fsa(data, [radius], features=features)
+
+
+def _stage_score(X, models, data_off):
+    return fsa.pp_gmm_batch(X, models, data_off)
+
+
+def _stage_score_loop(X, models, data_off):
+    return [fsa.pp_gmm(X[fsa.graph_slice(data_off, i),:], models)
+            for i in range(0, len(data_off)-1)]
+
+
+def benchmark(options):
+    """Benchmark all stages across graph sizes and radii.
+
+    Parameters
+    ----------
+
+    options : object returned by parse_args() of OptionParser
+        CLI options.
+
+    Returns
+    -------
+
+    results : list of dict
+        One record per (stage, size, radius) with the wall time
+        (min. over repetitions) and the peak memory increase.
+    """
+
+    logger = logging.getLogger()
+
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='pyfsa_bench')
+    try:
+        for n in options.sizes:
+            # Generate (and store) a set of graphs of that size
+            graphs, data = [], []
+            for i in range(0, options.graphs):
+                seed = None
+                if not options.seed is None:
+                    seed = options.seed + i
+                G = synthetic_graph(n, options.labels, options.loops,
+                                    seed=seed)
+                graphs.append(G)
+                base = os.path.join(tmp_dir, "g%d_%d" % (n, i))
+                graph_file, label_file = write_graph(G, base)
+                data.append((graph_file, label_file, i % 2))
+
+            for r in options.radii:
+                logger.info("Benchmarking N=%d, radius=%d ..." % (n, r))
+                stages = []
+
+                def _record(stage, fun, *args):
+                    runs = [measure(fun, *args)
+                            for k in range(0, options.repeat)]
+                    res = runs[0][0]
+                    peaks = [e[2] for e in runs if not e[2] is None]
+                    stages.append({'stage' : stage,
+                                   'n_vertices' : n,
+                                   'radius' : r,
+                                   'n_graphs' : options.graphs,
+                                   'seconds' : min(e[1] for e in runs),
+                                   'peak_rss_kb' : max(peaks) if len(peaks)
+                                                   else None})
+                    logger.info("%s : %.3f [sec], %s [KB]" %
+                                (stage, stages[-1]['seconds'],
+                                 stages[-1]['peak_rss_kb']))
+                    return res
+
+                _record('compute_graph_features', _stage_graph_features,
+                        graphs, r, options.features)
+
+                fsa_res = _record('run_fsa', _stage_run_fsa,
+                                  data, r, options.features)
+                X = fsa_res['data_mat']
+                data_off = fsa_res['data_off']
+
+                codewords = min(options.codewords, X.shape[0])
+                _record('learn_codebook', fsa.learn_codebook,
+                        X, codewords, options.seed)
+                _record('learn_codebook_minibatch',
+                        fsa.learn_codebook_minibatch,
+                        X, codewords, options.seed)
+
+                models = [fsa.estimate_gm(X, options.mixComp, options.seed)
+                          for c in range(0, 2)]
+                _record('pp_gmm', _stage_score_loop, X, models, data_off)
+                _record('pp_gmm_batch', _stage_score, X, models, data_off)
+
+                results.extend(stages)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = OptionParser()
+    parser.add_option("",
+                      "--sizes",
+                      default="100,200,400",
+                      help="list of graph sizes (#vertices), e.g., 100,200")
+    parser.add_option("",
+                      "--radii",
+                      default="1,2",
+                      help="list of neighborhood radi(i), e.g., 1,2,3")
+    parser.add_option("",
+                      "--graphs",
+                      default=4,
+                      type="int",
+                      help="number of graphs per size.")
+    parser.add_option("",
+                      "--labels",
+                      default=4,
+                      type="int",
+                      help="size of the vertex label alphabet.")
+    parser.add_option("",
+                      "--loops",
+                      default=0.05,
+                      type="float",
+                      help="number of loop-closing edges (relative to N).")
+    parser.add_option("",
+                      "--features",
+                      help="list of FSA feature names (default: all).")
+    parser.add_option("",
+                      "--codewords",
+                      default=50,
+                      type="int",
+                      help="number of codewords.")
+    parser.add_option("",
+                      "--mixComp",
+                      default=3,
+                      type="int",
+                      help="number of GMM components.")
+    parser.add_option("",
+                      "--repeat",
+                      default=1,
+                      type="int",
+                      help="number of repetitions per stage (min. time).")
+    parser.add_option("",
+                      "--seed",
+                      default=0,
+                      type="int",
+                      help="Seed for random number generator.")
+    parser.add_option("",
+                      "--out",
+                      help="JSON output file (default: stdout).")
+    parser.add_option("",
+                      "--logLevel",
+                      default="info",
+                      help="set logging level.")
+    parser.add_option("",
+                      "--logTo",
+                      help="Specify logging file.")
+    (options, args) = parser.parse_args()
+
+    options.sizes = [int(e) for e in options.sizes.split(',')]
+    options.radii = [int(e) for e in options.radii.split(',')]
+    if not options.features is None:
+        options.features = [e.strip() for e in options.features.split(',')]
+
+    utils.setup_logging(options)
+
+    report = {'python' : platform.python_version(),
+              'platform' : platform.platform(),
+              'numpy' : np.__version__,
+              'networkx' : nx.__version__,
+              'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+              'options' : vars(options),
+              'results' : benchmark(options)}
+
+    if options.out is None:
+        sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    else:
+        with open(options.out, 'w') as fid:
+            json.dump(report, fid, indent=2)
+
+
+if __name__ == "__main__":
+    main()
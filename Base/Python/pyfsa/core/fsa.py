@@ -34,42 +34,157 @@ from networkx.algorithms import bipartite
 # Machine learning
 import sklearn.mixture.gmm as gm
 from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
 
 from collections import defaultdict
+from collections import OrderedDict
 
 # Misc.
 import logging
 import numpy as np
 import scipy.sparse
+try:
+    from scipy.special import logsumexp
+except ImportError:
+    # SciPy < 0.19
+    from scipy.misc import logsumexp
+from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
+import tempfile
+
+from .profiling import Profiler
 import time
 import sys
 import os
 
 
-attr_list = [ #Average degree
-             lambda g : np.mean([e for e in g.degree().values()]),
-             # Average eccentricity
-             lambda g : np.mean([i for i in nx.eccentricity(g).values()]),
-             # Average closeness centrality
-             lambda g : np.mean([e for e in nx.closeness_centrality(g).values()]),
-             # Percentage of isolated points (i.e., degree(v) = 1)
-             lambda g : float(len(np.where(np.array(nx.degree(g).values())==1)[0]))/g.order(),
-             # Spectral radius (i.e., largest AM eigenvalue)
-             lambda g : np.abs(nx.adjacency_spectrum(g))[0],
-             # Spectral trace (i.e., sum of abs. eigenvalues)
-             lambda g : np.sum(np.abs(nx.adjacency_spectrum(g))),
-             # Label entropy, as defined in [2]
-             lambda g : label_entropy([e[1]['type'] for e in g.nodes(data=True)]),
-             # Mixing coefficient of attributes
-             lambda g : np.linalg.det(nx.attribute_mixing_matrix(g,'type')),
-             # Avg. #vertics with eccentricity == radius (i.e., central points)
-             lambda g : np.mean(float(len(nx.center(g)))/g.order()),
-             # Link impurity, as defined in [2]
-             lambda g : link_impurity(g),
-             # Diameter := max(eccentricity)
-             lambda g : nx.diameter(g),
-             # Radius := min(eccentricity)
-             lambda g : nx.radius(g)]
+# Registry of vertex neighborhood features. The order of registration
+# determines the column order of the feature matrix. Additional features
+# can be added via 'register_feature'; callers select a subset by name
+# (see 'compute_graph_features' and 'run_fsa').
+FEATURES = OrderedDict([
+    # Average degree
+    ('avg_degree',
+     lambda g : np.mean([e for e in g.degree().values()])),
+    # Average eccentricity
+    ('avg_eccentricity',
+     lambda g : np.mean([i for i in nx.eccentricity(g).values()])),
+    # Average closeness centrality
+    ('avg_closeness',
+     lambda g : np.mean([e for e in nx.closeness_centrality(g).values()])),
+    # Percentage of isolated points (i.e., degree(v) = 1)
+    ('isolated_ratio',
+     lambda g : float(len(np.where(np.array(nx.degree(g).values())==1)[0]))/g.order()),
+    # Spectral radius (i.e., largest AM eigenvalue)
+    ('spectral_radius',
+     lambda g : np.abs(nx.adjacency_spectrum(g))[0]),
+    # Spectral trace (i.e., sum of abs. eigenvalues)
+    ('spectral_trace',
+     lambda g : np.sum(np.abs(nx.adjacency_spectrum(g)))),
+    # Label entropy, as defined in [2]
+    ('label_entropy',
+     lambda g : label_entropy([e[1]['type'] for e in g.nodes(data=True)])),
+    # Mixing coefficient of attributes
+    ('attribute_mixing',
+     lambda g : np.linalg.det(nx.attribute_mixing_matrix(g,'type'))),
+    # Avg. #vertics with eccentricity == radius (i.e., central points)
+    ('center_ratio',
+     lambda g : np.mean(float(len(nx.center(g)))/g.order())),
+    # Link impurity, as defined in [2]
+    ('link_impurity',
+     lambda g : link_impurity(g)),
+    # Diameter := max(eccentricity)
+    ('diameter',
+     lambda g : nx.diameter(g)),
+    # Radius := min(eccentricity)
+    ('radius',
+     lambda g : nx.radius(g))])
+
+# Cumulative wall time (in seconds) and number of calls per feature
+feature_time = defaultdict(float)
+feature_calls = defaultdict(int)
+
+
+def register_feature(name, fun):
+    """Register a vertex neighborhood feature.
+
+    Parameters
+    ----------
+
+    name : string
+        Unique feature name.
+
+    fun : callable
+        Function that takes a networkx (sub)graph and returns
+        a scalar feature value.
+    """
+
+    if name in FEATURES:
+        raise Exception("Feature %s already registered!" % name)
+    FEATURES[name] = fun
+
+
+def attr_list():
+    """Get the functions of all registered features.
+
+    The list is derived from the registry on each call, so it includes
+    features added via 'register_feature'.
+
+    Returns
+    -------
+
+    features : list of functions (in order of registration)
+    """
+
+    return list(FEATURES.values())
+
+
+def select_features(names=None):
+    """Resolve feature names to registered feature functions.
+
+    Parameters
+    ----------
+
+    names : list of 'string' (default : None)
+        Desired feature names. If 'None', all registered features
+        are selected (in order of registration).
+
+    Returns
+    -------
+
+    features : list of (name, function) tuples
+    """
+
+    if names is None:
+        return list(FEATURES.items())
+    unknown = [name for name in names if not name in FEATURES]
+    if len(unknown):
+        raise Exception("Unknown feature(s): %s!" % ", ".join(unknown))
+    return [(name, FEATURES[name]) for name in names]
+
+
+def reset_feature_timings():
+    """Reset per-feature timing information."""
+    feature_time.clear()
+    feature_calls.clear()
+
+
+def get_feature_timings():
+    """Get per-feature timing information.
+
+    Returns
+    -------
+
+    timings : dict
+        Maps each feature name to a dict with the cumulative wall
+        time ('time', in seconds) and the number of calls ('calls')
+        since the last call to 'reset_feature_timings'.
+    """
+
+    return dict((name, {'time' : feature_time[name],
+                        'calls' : feature_calls[name]})
+                for name in feature_calls)
 
 
 def link_impurity(g):
@@ -179,7 +294,79 @@ def graph_from_file(graph_file, label_file=None, n_skip=0):
     return G
 
 
-def compute_graph_features(g, radius=2, sps=None, omit_degenerate=False):
+def sample_vertices(g, budget=None, method='uniform', seed=None):
+    """Select a subset of the vertices of a graph.
+
+    Parameters
+    ----------
+
+    g : networkx input graph with N vertices (labeled 0,...,N-1)
+        The input graph.
+
+    budget : int (default : None)
+        Number of vertices to select. If 'None' or >= N, all
+        vertices are selected.
+
+    method : string (default : 'uniform')
+        Sampling strategy:
+
+        'uniform' : uniform sampling (without replacement)
+        'degree'  : stratified by vertex degree, i.e., each degree
+                    is represented proportionally to its frequency
+        'fps'     : farthest-point sampling w.r.t. the shortest-path
+                    distance, i.e., vertices spread over the graph
+
+    seed : int (default : None)
+        Seed for the random number generator.
+
+    Returns
+    -------
+
+    vertices : numpy array, shape (min(budget, N),)
+        Sorted indices of the selected vertices.
+    """
+
+    n = len(g)
+    if budget is None or budget >= n:
+        return np.arange(0, n)
+
+    rng = np.random.RandomState(seed)
+    if method == 'uniform':
+        return np.sort(rng.permutation(n)[:budget])
+
+    elif method == 'degree':
+        deg = np.array([g.degree(v) for v in range(0, n)])
+        strata, inv = np.unique(deg, return_inverse=True)
+        counts = np.bincount(inv)
+        # Proportional allocation (largest remainder)
+        quota = budget * counts.astype(float) / n
+        alloc = np.floor(quota).astype(int)
+        rest = np.argsort(alloc - quota)[:budget - alloc.sum()]
+        alloc[rest] += 1
+        vertices = []
+        for k in np.where(alloc > 0)[0]:
+            members = np.where(inv == k)[0]
+            vertices.extend(members[rng.permutation(len(members))[:alloc[k]]])
+        return np.sort(np.asarray(vertices, dtype=int))
+
+    elif method == 'fps':
+        dist = np.ones(n) * np.inf
+        v = rng.randint(0, n)
+        vertices = []
+        for i in range(0, budget):
+            vertices.append(v)
+            dist[v] = 0
+            for u, d in nx.single_source_shortest_path_length(g, v).items():
+                dist[u] = min(dist[u], d)
+            # Unreachable vertices (other components) come first
+            v = np.argmax(dist)
+        return np.sort(np.asarray(vertices, dtype=int))
+
+    raise Exception("Sampling method %s not supported!" % method)
+
+
+def compute_graph_features(g, radius=2, sps=None, omit_degenerate=False,
+        features=None, vertices=None):
     """Compute graph feature vector(s).
 
     Parameters
@@ -203,43 +390,63 @@ def compute_graph_features(g, radius=2, sps=None, omit_degenerate=False):
         not considered. Otherwise, the feature vector for such a sub-
         graph is just a vector of zeros.
 
+    features : list of 'string' (default : None)
+        Names of the features to compute (see 'FEATURES'). If 'None',
+        all registered features are computed.
+
+    vertices : list of 'int' (default : None)
+        Compute features only for the neighborhoods of these vertices
+        (e.g., from 'sample_vertices'). Neighborhoods are then found
+        by a breadth-first search up to the given radius, instead of
+        computing all shortest paths (unless 'sps' is given).
+
     Returns
     -------
 
     v_mat : numpy matrix, shape (N, D)
         A D-dimensional feature matrix with one feature vector for
-        each vertex. Features are computed for the given radius.
+        each vertex (or each vertex in 'vertices', in that order).
+        Features are computed for the given radius.
     """
 
     logger = logging.getLogger()
 
     # Recompute shortest paths if neccessary
-    if sps is None:
+    if sps is None and vertices is None:
         sps = nx.floyd_warshall_numpy(g)
+    if vertices is None:
+        vertices = g.nodes()
+
+    feature_set = select_features(features)
 
     # Feature matrix representation of graph
-    v_mat = np.zeros([len(g),len(attr_list)])
+    v_mat = np.zeros([len(vertices),len(feature_set)])
 
     # Iterate over all nodes
     degenerates = []
-    for n in g.nodes():
-        # Get n-th row of shortest path matrix
-        nth_row = np.array(sps[n,:]).ravel()
-        # Find elements within a certain radius
-        within_radius = np.where(nth_row <= radius)
+    for i, n in enumerate(vertices):
+        if sps is None:
+            # Find elements within a certain radius (BFS)
+            within_radius = [sorted(nx.single_source_shortest_path_length(
+                g, n, cutoff=radius).keys())]
+        else:
+            # Get n-th row of shortest path matrix
+            nth_row = np.array(sps[n,:]).ravel()
+            # Find elements within a certain radius
+            within_radius = np.where(nth_row <= radius)
         # Build a subgraph from those nodes
         sg = g.subgraph(within_radius[0])
         # Single vertex sg is considered degenerate
         if len(sg.nodes()) == 1:
             # Keep track of degenerates
-            degenerates.append(n)
-            if omit_degenerate:
-                continue
-            # Feature vector is 0-vector
-            v = np.zeros((len(attr_list),))
-        else:
-            v = [attr_fun(sg) for attr_fun in attr_list]
-        v_mat[n,:] = np.asarray(v)
+            degenerates.append(i)
+            # Feature vector is 0-vector (v_mat is zero-initialized)
+            continue
+        for j, (name, attr_fun) in enumerate(feature_set):
+            t0 = time.time()
+            v_mat[i,j] = attr_fun(sg)
+            feature_time[name] += time.time() - t0
+            feature_calls[name] += 1
 
     logger.info("Found %d generate cases!" % len(degenerates))
     if len(degenerates):
@@ -251,7 +458,8 @@ def compute_graph_features(g, radius=2, sps=None, omit_degenerate=False):
 
 
 def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
-        omit_degenerate=False):
+        omit_degenerate=False, features=None, mmap=False, sample=None,
+        budget=None, seed=None, profiler=None):
     """Run (f)ine-(s)tructure (a)nalysis.
 
     Paramters
@@ -279,6 +487,8 @@ def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
         where 'data.mat' contains the feature matrix, i.e., one
         feature vector per vertex; 'data.idx' contains the indices
         that identify which graph each feature vector belongs to;
+        If 'mmap' is 'True', the feature matrix is written to
+        '/tmp/data.npy' instead of 'data.mat'.
 
     skip : int (default : 0)
         Skip N header entries when loading graphs.
@@ -289,6 +499,30 @@ def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
         not considered. Otherwise, the feature vector for such a sub-
         graph is just a vector of zeros.
 
+    features : list of 'string' (default : None)
+        Names of the features to compute (see 'FEATURES'). If 'None',
+        all registered features are computed.
+
+    mmap : boolean (default : False)
+        If 'True', the feature matrix is stored as .npy file (requires
+        'out') and returned read-only memory-mapped (see
+        'memmap_features').
+
+    sample : string (default : None)
+        Vertex sampling strategy ('uniform', 'degree' or 'fps', see
+        'sample_vertices'). If given, features are computed for the
+        neighborhoods of at most 'budget' vertices per graph.
+
+    budget : int (default : None)
+        Max. number of sampled vertices per graph.
+
+    seed : int (default : None)
+        Seed for vertex sampling; the i-th graph uses seed + i.
+
+    profiler : profiling.Profiler (default : None)
+        If given, records the time spent on loading graphs ('load')
+        and on computing features for each radius ('features.r<R>'),
+        as well as the number of graphs and vertices.
 
     Returns
     -------
@@ -299,6 +533,13 @@ def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
         L : numpy array, shape (#total vertices,)
             Identifies to which graph a feature vector belongs
             to.
+
+        O : numpy array, shape (N+1,)
+            Row offsets of each graph, see 'build_graph_index'.
+
+        T : dict
+            Per-feature timing information, see 'get_feature_timings'
+            (empty if features were loaded from disk).
     """
 
     logger = logging.getLogger()
@@ -306,26 +547,58 @@ def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
     if radii is None:
         raise Exception("No radii given!")
 
+    if profiler is None:
+        profiler = Profiler()
+
+    if mmap and out is None:
+        raise Exception("Memory-mapping requires an output file!")
+
     if not out is None:
         mat_file = "%s.mat" % out
+        if mmap:
+            mat_file = "%s.npy" % out
         idx_file = "%s.idx" % out
         if not recompute:
             if (os.path.exists(mat_file) and
                 os.path.exists(idx_file)):
                 logger.info("Loading data from file(s).")
-                data_mat = np.genfromtxt(mat_file)
-                data_idx = np.genfromtxt(idx_file)
+                with profiler.stage('load'):
+                    if mmap:
+                        data_mat = np.load(mat_file, mmap_mode='r')
+                    else:
+                        data_mat = np.genfromtxt(mat_file)
+                    data_idx = np.genfromtxt(idx_file)
                 return {'data_mat' : data_mat,
-                        'data_idx' : data_idx}
+                        'data_idx' : data_idx,
+                        'data_off' : build_graph_index(data_idx, len(data)),
+                        'feature_timings' : {}}
+
+    # Validate feature selection before doing any work
+    select_features(features)
+    reset_feature_timings()
 
     data_mat = []
     data_idx = []
     for idx, (cf, lf, lab) in enumerate(data):
-        logger.info("Processing %d-th graph ..." % idx)
+        logger.info("Processing graph %d/%d ..." % (idx+1, len(data)))
+
+        with profiler.stage('load'):
+            T, x = graph_from_file(cf, lf, skip), []
+        profiler.count('graphs')
+        profiler.count('vertices', len(T))
+
+        # Use the same vertices for all radii
+        vertices = None
+        if not sample is None:
+            vertices = sample_vertices(T, budget, sample,
+                                       None if seed is None else seed + idx)
+            logger.debug("Sampled %d of %d vertices." %
+                         (len(vertices), len(T)))
 
-        T, x = graph_from_file(cf, lf, skip), []
         for r in radii:
-            x.append(compute_graph_features(T, r, None, omit_degenerate))
+            with profiler.stage('features.r%d' % r):
+                x.append(compute_graph_features(T, r, None, omit_degenerate,
+                                                features, vertices))
         xs = np.hstack(tuple(x))
         data_mat.append(xs)
         data_idx.append(np.ones((xs.shape[0], 1))*idx)
@@ -334,11 +607,119 @@ def run_fsa(data, radii=None, recompute=True, out=None, skip=0,
     data_idx = np.vstack(tuple(data_idx))
 
     if not out is None:
-        np.savetxt(mat_file, data_mat, delimiter=' ')
+        if mmap:
+            data_mat = memmap_features(data_mat, mat_file)
+        else:
+            np.savetxt(mat_file, data_mat, delimiter=' ')
         np.savetxt(idx_file, data_idx, delimiter=' ',fmt="%d")
+    profiler.count('feature_vectors', data_mat.shape[0])
+
+    feature_timings = get_feature_timings()
+    for name, t in sorted(feature_timings.items(),
+                          key=lambda e: e[1]['time'], reverse=True):
+        logger.info("Feature %s : %.3f [sec] in %d calls" %
+                    (name, t['time'], t['calls']))
 
     return {'data_mat' : data_mat,
-            'data_idx' : data_idx}
+            'data_idx' : data_idx,
+            'data_off' : build_graph_index(data_idx, len(data)),
+            'feature_timings' : feature_timings}
+
+
+def build_graph_index(data_idx, n_graphs=None):
+    """Build a graph-to-row index from per-row graph indices.
+
+    Parameters
+    ----------
+
+    data_idx : numpy array, shape (N,)
+        Identifies to which graph a feature vector belongs to
+        (see 'run_fsa'). Needs to be sorted, i.e., the rows of
+        each graph are contiguous.
+
+    n_graphs : int (default : None)
+        Number of graphs G. If 'None', max(data_idx)+1 is used.
+
+    Returns
+    -------
+
+    data_off : numpy array, shape (G+1,)
+        Row offsets, i.e., the feature vectors of the i-th graph
+        are the rows data_off[i]:data_off[i+1].
+    """
+
+    data_idx = np.asarray(data_idx).ravel().astype(int)
+    if np.any(np.diff(data_idx) < 0):
+        raise Exception("Graph indices are not sorted!")
+    if n_graphs is None:
+        n_graphs = data_idx.max()+1 if len(data_idx) else 0
+
+    data_off = np.zeros(n_graphs+1, dtype=int)
+    np.cumsum(np.bincount(data_idx, minlength=n_graphs), out=data_off[1:])
+    return data_off
+
+
+def graph_slice(data_off, i):
+    """Get the rows of the i-th graph as a slice.
+
+    Parameters
+    ----------
+
+    data_off : numpy array, shape (G+1,)
+        Row offsets, see 'build_graph_index'.
+
+    i : int
+        Graph index.
+
+    Returns
+    -------
+
+    s : slice
+        Slice of the rows of graph i.
+    """
+
+    return slice(data_off[i], data_off[i+1])
+
+
+def graph_rows(data_off, graphs, return_offsets=False):
+    """Get the rows of a set of graphs.
+
+    Parameters
+    ----------
+
+    data_off : numpy array, shape (G+1,)
+        Row offsets, see 'build_graph_index'.
+
+    graphs : list of 'int'
+        Graph indices.
+
+    return_offsets : boolean (default : False)
+        If 'True', also return the row offsets of the graphs
+        within the selected rows.
+
+    Returns
+    -------
+
+    rows : numpy array, shape (M,)
+        Row indices of all feature vectors of the given graphs
+        (in the order of 'graphs'), e.g., to select data with a
+        single fancy-index as X[rows,:].
+
+    offsets : numpy array, shape (len(graphs)+1,)
+        Row offsets into X[rows,:], see 'build_graph_index'. Only
+        returned if 'return_offsets' is 'True'.
+    """
+
+    graphs = np.asarray(graphs).ravel().astype(int)
+    starts = data_off[graphs]
+    lengths = data_off[graphs+1] - starts
+    ends = np.cumsum(lengths)
+    # Concatenation of arange(start, start+length) for all graphs
+    shift = np.repeat(starts - ends + lengths, lengths)
+    rows = shift + np.arange(0, lengths.sum())
+    if return_offsets:
+        return rows, np.concatenate(([0], ends)).astype(int)
+    return rows
 
 
 def estimate_gm(X,components=3,seed=None):
@@ -379,6 +760,134 @@ def estimate_gm(X,components=3,seed=None):
     return gm_obj
 
 
+def memmap_features(X, filename):
+    """Store a feature matrix on disk and re-open it memory-mapped.
+
+    The returned matrix is read-only and backed by the page cache,
+    so worker processes can open the same file (see 'estimate_gm_parallel')
+    without copying the data.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Input data.
+
+    filename : string
+        Name of the .npy file to write, e.g., '/tmp/data.npy'.
+
+    Returns
+    -------
+
+    X : numpy.memmap, shape (N,D)
+        Read-only memory-mapped feature matrix.
+    """
+
+    if not filename.endswith('.npy'):
+        filename = "%s.npy" % filename
+    np.save(filename, np.asarray(X))
+    return np.load(filename, mmap_mode='r')
+
+
+def _npy_filename(X):
+    """Name of the .npy file that X maps as a whole, or None.
+
+    Views of a memory-mapped matrix (e.g., 'X[50:]') keep the file name
+    of their parent, so the name is only returned if X has the shape,
+    layout and offset of the array stored in the file.
+    """
+
+    filename = getattr(X, 'filename', None)
+    if filename is None or not isinstance(X, np.memmap):
+        return None
+    try:
+        stored = np.load(filename, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    if (stored.shape != X.shape or stored.dtype != X.dtype or
+            stored.strides != X.strides or stored.offset != X.offset):
+        return None
+    return filename
+
+
+def _estimate_gm_job(args):
+    filename, rows, components, seed, scaler = args
+    X = np.load(filename, mmap_mode='r')
+    return estimate_gm(take_rows(X, rows, scaler), components, seed)
+
+
+def estimate_gm_parallel(X, row_sets, components=3, seed=None, n_jobs=1,
+                         scaler=None):
+    """Estimate Gaussian mixture models for several subsets of rows.
+
+    Models are estimated concurrently in 'n_jobs' processes that
+    share the (memory-mapped) feature matrix X; only the row indices
+    and the fitted models are passed between processes.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Matrix of data samples. Should be memory-mapped (see
+        'memmap_features'), otherwise X is dumped to a temporary
+        file first if n_jobs > 1.
+
+    row_sets : list of numpy arrays
+        Row indices of the samples for each model, e.g., the rows of
+        the training graphs of one class in one cross-validation fold
+        (see 'graph_rows').
+
+    components : int (default : 3)
+        Number of desired mixture components.
+
+    seed : int, or list of 'int' (default : None)
+        Seed for the random number generator; either one seed for
+        all models, or one seed per model.
+
+    n_jobs : int (default : 1)
+        Number of worker processes.
+
+    scaler : StandardScaler, or list of StandardScaler (default : None)
+        If given, samples are normalized before estimation; either
+        one scaler for all models, or one scaler per model (e.g.,
+        the scaler of the corresponding cross-validation fold).
+
+    Returns
+    -------
+
+    models : list of sklearn.mixture.gmm objects
+        Estimated GMMs (in the order of 'row_sets').
+    """
+
+    if not isinstance(seed, (list, tuple)):
+        seed = [seed] * len(row_sets)
+    if not isinstance(scaler, (list, tuple)):
+        scaler = [scaler] * len(row_sets)
+
+    if n_jobs <= 1:
+        return [estimate_gm(take_rows(X, rows, sc), components, s)
+                for rows, s, sc in zip(row_sets, seed, scaler)]
+
+    tmp_file = None
+    filename = _npy_filename(X)
+    if filename is None:
+        fd, tmp_file = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        filename = memmap_features(X, tmp_file).filename
+
+    jobs = [(filename, rows, components, s, sc)
+            for rows, s, sc in zip(row_sets, seed, scaler)]
+    try:
+        pool = Pool(n_jobs)
+        models = pool.map(_estimate_gm_job, jobs)
+        pool.close()
+        pool.join()
+    finally:
+        if not tmp_file is None:
+            os.remove(tmp_file)
+    return models
+
+
 def learn_codebook(X, codebook_size=200, seed=None):
     """Learn a codebook.
 
@@ -418,6 +927,268 @@ def learn_codebook(X, codebook_size=200, seed=None):
     return cb
 
 
+def iter_chunks(X, rows=None, chunk_size=10000, scaler=None):
+    """Iterate over chunks of rows of a feature matrix.
+
+    Only one chunk is held in memory at a time, so X can be a
+    memory-mapped matrix, e.g., loaded via np.load(..., mmap_mode='r').
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Input data.
+
+    rows : numpy array, shape (M,) (default : None)
+        Indices of the rows to iterate over (in that order). If
+        'None', all rows are visited in storage order.
+
+    chunk_size : int (default : 10000)
+        Max. number of rows per chunk.
+
+    scaler : sklearn.preprocessing.StandardScaler (default : None)
+        If given, each chunk is normalized (see 'fit_scaler').
+
+    Returns
+    -------
+
+    chunks : generator of numpy matrices, shape (<=chunk_size, D)
+    """
+
+    n = X.shape[0] if rows is None else len(rows)
+    for i in range(0, n, chunk_size):
+        if rows is None:
+            chunk = X[i:i+chunk_size,:]
+        else:
+            chunk = X[rows[i:i+chunk_size],:]
+        if not scaler is None:
+            chunk = scaler.transform(np.asarray(chunk, dtype=float))
+        yield chunk
+
+
+def take_rows(X, rows, scaler=None, chunk_size=10000):
+    """Select (and normalize) rows of a feature matrix.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Input data (possibly memory-mapped).
+
+    rows : numpy array, shape (M,)
+        Indices of the rows to select.
+
+    scaler : sklearn.preprocessing.StandardScaler (default : None)
+        If given, the selected rows are normalized in place, chunk
+        by chunk (see 'fit_scaler').
+
+    chunk_size : int (default : 10000)
+        Max. number of rows normalized at a time.
+
+    Returns
+    -------
+
+    X : numpy matrix, shape (M,D)
+        Copy of the selected rows.
+    """
+
+    Y = np.asarray(X[rows,:], dtype=float)
+    if not scaler is None:
+        # Rows taken from a read-only memory map stay read-only
+        if not Y.flags.writeable:
+            Y = Y.copy()
+        for i in range(0, Y.shape[0], chunk_size):
+            scaler.transform(Y[i:i+chunk_size,:], copy=False)
+    return Y
+
+
+def fit_scaler(X, rows=None, chunk_size=10000):
+    """Estimate feature means and variances from streamed chunks.
+
+    Only one chunk of rows is held in memory at a time, so the
+    scaler can be fit on the training portion of a (memory-mapped)
+    feature matrix that does not fit into memory.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Input data (possibly memory-mapped).
+
+    rows : numpy array, shape (M,) (default : None)
+        Indices of the rows to fit on, e.g., the training rows of
+        one cross-validation fold. If 'None', all rows are used.
+
+    chunk_size : int (default : 10000)
+        Max. number of rows per chunk.
+
+    Returns
+    -------
+
+    scaler : sklearn.preprocessing.StandardScaler object
+        Scaler after fitting (with mean/var. normalization).
+    """
+
+    logger = logging.getLogger()
+    logger.info("Estimating feature normalization ...")
+
+    scaler = StandardScaler()
+    for chunk in iter_chunks(X, rows, chunk_size):
+        scaler.partial_fit(chunk)
+    return scaler
+
+
+def iter_shuffled_chunks(X, rows, chunk_size=10000, block_size=None,
+                         rng=None, scaler=None):
+    """Iterate over chunks of randomly chosen, contiguous blocks of rows.
+
+    Rows are split into blocks of consecutive rows (in storage
+    order). Each chunk consists of randomly chosen blocks (each block
+    is visited once) in random order within the chunk. As blocks are
+    read sequentially, this is suited for memory-mapped matrices.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Input data (possibly memory-mapped).
+
+    rows : numpy array, shape (M,)
+        Indices of the rows to iterate over.
+
+    chunk_size : int (default : 10000)
+        Max. number of rows per chunk.
+
+    block_size : int (default : None)
+        Number of consecutive rows per block. If 'None', chunk_size/8,
+        i.e., each chunk mixes rows from 8 places of X.
+
+    rng : numpy.random.RandomState (default : None)
+        Random number generator.
+
+    scaler : sklearn.preprocessing.StandardScaler (default : None)
+        If given, each chunk is normalized (see 'fit_scaler').
+
+    Returns
+    -------
+
+    chunks : generator of numpy matrices, shape (<=chunk_size, D)
+    """
+
+    if rng is None:
+        rng = np.random.RandomState()
+    if block_size is None:
+        block_size = max(chunk_size // 8, 1)
+    block_size = min(block_size, chunk_size)
+    blocks_per_chunk = max(chunk_size // block_size, 1)
+
+    rows = np.sort(np.asarray(rows).ravel())
+    starts = np.arange(0, len(rows), block_size)
+    if len(rows) % block_size:
+        # Visit the short last block last, so that the first chunk
+        # (e.g., to initialize K-Means) is complete
+        starts = np.append(starts[:-1][rng.permutation(len(starts)-1)],
+                           starts[-1])
+    else:
+        starts = starts[rng.permutation(len(starts))]
+    for i in range(0, len(starts), blocks_per_chunk):
+        parts = []
+        for s in starts[i:i+blocks_per_chunk]:
+            block = rows[s:s+block_size]
+            if block[-1] - block[0] + 1 == len(block):
+                # Consecutive rows: sequential read
+                parts.append(np.asarray(X[block[0]:block[-1]+1,:]))
+            else:
+                parts.append(np.asarray(X[block,:]))
+        chunk = np.vstack(parts)
+        chunk = chunk[rng.permutation(chunk.shape[0]),:]
+        if not scaler is None:
+            chunk = scaler.transform(np.asarray(chunk, dtype=float))
+        yield chunk
+
+
+def learn_codebook_minibatch(X, codebook_size=200, seed=None, rows=None,
+                             chunk_size=10000, n_passes=1, init=None,
+                             scaler=None, block_size=None):
+    """Learn a codebook from streamed chunks of data.
+
+    Run mini-batch K-Means, where each chunk of rows (see
+    'iter_chunks') is one mini-batch. Memory usage is bounded
+    by the chunk size, independent of the number of rows.
+
+    Paramters
+    ---------
+
+    X : numpy matrix, shape (N,D)
+        Input data (possibly memory-mapped).
+
+    codebook_size : int (default : 200)
+        Desired number of codewords.
+
+    seed : int (default : None)
+        Seed for random number generator.
+
+    rows : numpy array, shape (M,) (default : None)
+        Indices of the rows to learn from. If 'None', all rows
+        are used.
+
+    chunk_size : int (default : 10000)
+        Number of rows per mini-batch. Needs to be >= codebook_size
+        unless 'init' is given.
+
+    n_passes : int (default : 1)
+        Number of passes over the data. Rows are visited in
+        random order of blocks (see 'iter_shuffled_chunks') in each
+        pass.
+
+    init : numpy array, shape (codebook_size,D) (default : None)
+        Initial codewords, e.g., the 'cluster_centers_' of a
+        codebook learned on a previous cross-validation fold
+        (warm-start). If 'None', K-Means++ is run on the first
+        chunk.
+
+    scaler : sklearn.preprocessing.StandardScaler (default : None)
+        If given, chunks are normalized before clustering.
+
+    block_size : int (default : None)
+        Number of consecutive rows read at once (see
+        'iter_shuffled_chunks').
+
+    Returns
+    -------
+
+    cb : sklearn.cluster.MiniBatchKMeans object
+        MiniBatchKMeans object after fitting.
+    """
+
+    logger = logging.getLogger()
+    logger.info("Learning codebook with %d words (mini-batch) ..." %
+                codebook_size)
+
+    if rows is None:
+        rows = np.arange(X.shape[0])
+    rows = np.asarray(rows).ravel()
+
+    if init is None:
+        cb = MiniBatchKMeans(codebook_size,
+                             init="k-means++",
+                             random_state=seed)
+    else:
+        cb = MiniBatchKMeans(codebook_size,
+                             init=np.asarray(init),
+                             n_init=1,
+                             random_state=seed)
+
+    rng = np.random.RandomState(seed)
+    for p in range(0, n_passes):
+        # Chunks of consecutive rows all stem from a few graphs, so
+        # mix blocks from across X (which keeps reads sequential)
+        for chunk in iter_shuffled_chunks(X, rows, chunk_size, block_size,
+                                          rng, scaler):
+            cb.partial_fit(chunk)
+    return cb
+
+
 def bow(X, cb):
     """Compute a (normalized) BoW histogram.
 
@@ -448,6 +1219,78 @@ def bow(X, cb):
     return np.histogram(assignments,bins=B,density=True)[0]
 
 
+def bow_batch(X, data_idx, cb, graphs=None, chunk_size=10000, scaler=None):
+    """Compute (normalized) BoW histograms for many graphs at once.
+
+    All feature vectors are assigned to codewords in one pass, and
+    the histograms are built with a single 'np.bincount' over the
+    combined (graph, codeword) index, i.e., in O(#vertices) overall.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N, D)
+        Input data (possibly memory-mapped).
+
+    data_idx : numpy array, shape (N,)
+        Identifies to which graph a feature vector belongs to
+        (see 'run_fsa').
+
+    cb : sklearn.cluster.KMeans
+        Already estimated codebook with C codewords.
+
+    graphs : list of 'int' (default : None)
+        Unique indices of the graphs for which histograms are
+        computed; these determine the row order of H. If 'None',
+        all graphs 0,...,max(data_idx) are used.
+
+    chunk_size : int (default : 10000)
+        Max. number of feature vectors assigned at a time.
+
+    scaler : sklearn.preprocessing.StandardScaler (default : None)
+        If given, feature vectors are normalized before assignment.
+
+    Returns
+    -------
+
+    H : numpy array, shape (G, C)
+        Normalized BoW histograms (one row per graph), identical
+        to the output of 'bow' for each graph.
+    """
+
+    # Get nr. codewords
+    n,d = cb.cluster_centers_.shape
+    if d != X.shape[1]:
+        raise Exception("Dimensionality mismatch!")
+
+    data_idx = np.asarray(data_idx).ravel().astype(int)
+    if graphs is None:
+        graphs = np.arange(0, data_idx.max()+1)
+    graphs = np.asarray(graphs).ravel().astype(int)
+    n_graphs = len(graphs)
+
+    # Map graph index to histogram row (-1 if graph is not requested)
+    lut = -np.ones(max(data_idx.max(), graphs.max())+1, dtype=int)
+    lut[graphs] = np.arange(0, n_graphs)
+    h_row = lut[data_idx]
+    sel = np.where(h_row >= 0)[0]
+
+    # Compute closest cluster centers
+    assignments = np.zeros(len(sel), dtype=int)
+    for i, chunk in enumerate(iter_chunks(X, sel, chunk_size, scaler)):
+        assignments[i*chunk_size:i*chunk_size+len(chunk)] = cb.predict(chunk)
+
+    # Count (graph, codeword) co-occurrences
+    H = np.bincount(h_row[sel]*n + assignments, minlength=n_graphs*n)
+    H = H.reshape((n_graphs, n)).astype(float)
+
+    # Normalize (unit bin width, as in 'bow')
+    counts = H.sum(axis=1)
+    nz = counts > 0
+    H[nz,:] /= counts[nz,np.newaxis]
+    return H
+
+
 def pp_gmm(X, models, argmax=True):
     """Compute the posterior probability of X under a set of GMM models.
 
@@ -499,3 +1342,161 @@ def pp_gmm(X, models, argmax=True):
         t1 = np.log(np.sum(np.exp(ll - np.tile(t0,(1,n_models))),axis=1)) + t0
         prob = np.exp(np.asmatrix(ll) - t1)
         return prob
+
+
+def _stack_gmm_params(models):
+    """Stack the parameters of diagonal-covariance GMMs.
+
+    Parameters
+    ----------
+
+    models : list of sklearn.mixture.gmm objects
+        List of C estimated GMMs with K_1,...,K_C components.
+
+    Returns
+    -------
+
+    params : tuple
+        Stacked precision matrix P and precision-weighted means MP
+        (both of shape (K, D), with K = K_1 + ... + K_C), constant
+        terms of the component log-densities, shape (K,), and the
+        component offsets of each model, shape (C+1,).
+    """
+
+    precs, mps, consts, comp_off = [], [], [], [0]
+    for model in models:
+        if getattr(model, 'covariance_type', 'diag') != 'diag':
+            raise Exception("Only diagonal covariance GMMs supported!")
+        # sklearn.mixture.GaussianMixture uses 'covariances_'
+        covars = getattr(model, 'covars_', None)
+        if covars is None:
+            covars = model.covariances_
+        mu = np.asarray(model.means_, dtype=float)
+        prec = 1.0/np.asarray(covars, dtype=float)
+        k, d = mu.shape
+        precs.append(prec)
+        mps.append(mu*prec)
+        consts.append(np.log(model.weights_)
+                      - 0.5*d*np.log(2*np.pi)
+                      + 0.5*np.sum(np.log(prec), axis=1)
+                      - 0.5*np.sum(mu**2*prec, axis=1))
+        comp_off.append(comp_off[-1] + k)
+    return (np.vstack(precs), np.vstack(mps), np.concatenate(consts),
+            np.asarray(comp_off))
+
+
+def score_gmms(X, models, chunk_size=10000, n_jobs=1):
+    """Compute the log-likelihood of X under a set of GMM models.
+
+    All component log-densities of all models are evaluated in
+    one vectorised pass (two matrix products per chunk of rows).
+
+    Note: Only supports diagonal covariance matrices.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Data samples (possibly memory-mapped).
+
+    models : list of sklearn.mixture.gmm objects
+        List of C estimated GMMs.
+
+    chunk_size : int (default : 10000)
+        Max. number of rows scored at a time.
+
+    n_jobs : int (default : 1)
+        Number of threads that score chunks concurrently.
+
+    Returns
+    -------
+
+    ll : numpy array, shape (N, C)
+        Log-likelihood of each row in X under each model (equal to
+        'model.score(X)' for each model).
+    """
+
+    P, MP, const, comp_off = _stack_gmm_params(models)
+    n = X.shape[0]
+    ll = np.zeros((n, len(models)))
+
+    def _score_chunk(start):
+        x = np.asarray(X[start:start+chunk_size,:], dtype=float)
+        lpr = np.dot(x, MP.T) - 0.5*np.dot(x**2, P.T) + const
+        for i in range(0, len(models)):
+            ll[start:start+len(x),i] = logsumexp(
+                lpr[:,comp_off[i]:comp_off[i+1]], axis=1)
+
+    starts = range(0, n, chunk_size)
+    if n_jobs > 1 and len(starts) > 1:
+        pool = ThreadPool(n_jobs)
+        pool.map(_score_chunk, starts)
+        pool.close()
+        pool.join()
+    else:
+        for start in starts:
+            _score_chunk(start)
+    return ll
+
+
+def pp_gmm_batch(X, models, data_off=None, argmax=True, chunk_size=10000,
+                 n_jobs=1):
+    """Compute the posterior probabilities of many graphs under a set of
+    GMM models at once.
+
+    Note: Only supports diagonal covariance matrices; we assume equal
+    prior probabilities for each class.
+
+    Parameters
+    ----------
+
+    X : numpy matrix, shape (N,D)
+        Data samples of G graphs (possibly memory-mapped).
+
+    models : list of sklearn.mixture.gmm objects
+        List of C estimated GMMs.
+
+    data_off : numpy array, shape (G+1,) (default : None)
+        Row offsets of the graphs in X (see 'build_graph_index'
+        and 'graph_rows'). If 'None', X holds a single graph.
+
+    argmax : boolean (default : True)
+        If 'True', the index of the class with the highest a-
+        posteriori probability is computed for each graph. If
+        'False', the a-posteriori probability of each class is
+        computed for each row in X (as in 'pp_gmm').
+
+    chunk_size : int (default : 10000)
+        Max. number of rows scored at a time.
+
+    n_jobs : int (default : 1)
+        Number of threads used for scoring, see 'score_gmms'.
+
+    Returns
+    -------
+
+    maxp : numpy array with shape (G,), or (N, C)
+        Depending on whether 'argmax' is 'True' or 'False', the
+        index of the class with the highest a-posteriori probability
+        for each graph, or the a-posteriori probabilities under each
+        model for each row in X.
+    """
+
+    ll = score_gmms(X, models, chunk_size, n_jobs)
+
+    if not argmax:
+        # LogSumExp to compute row-wise MAP
+        return np.exp(ll - logsumexp(ll, axis=1)[:,np.newaxis])
+
+    if data_off is None:
+        data_off = np.asarray([0, X.shape[0]])
+    n_graphs = len(data_off)-1
+
+    # Sum log-likelihoods over the rows of each graph
+    graph_of_row = np.repeat(np.arange(0, n_graphs), np.diff(data_off))
+    sump = np.zeros((n_graphs, len(models)))
+    for i in range(0, len(models)):
+        sump[:,i] = np.bincount(graph_of_row, weights=ll[:,i],
+                                minlength=n_graphs)
+    # Normalization does not change the argmax
+    return np.argmax(sump, axis=1)
@@ -0,0 +1,210 @@
+"""profiling.py
+
+Lightweight instrumentation (stage timers, counters and memory
+sampling) for applications that use pyfsa.
+"""
+
+
+__license__ = "Apache License, Version 2.0 (see TubeTK)"
+__author__  = "Roland Kwitt, Kitware Inc., 2013"
+__email__   = "E-Mail: roland.kwitt@kitware.com"
+__status__  = "Development"
+
+
+from collections import OrderedDict
+from collections import defaultdict
+from contextlib import contextmanager
+
+import logging
+import json
+import time
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_rss_kb(children=False):
+    """Get the peak resident set size.
+
+    Parameters
+    ----------
+
+    children : boolean (default : False)
+        If 'True', return the peak RSS of the (terminated) child
+        processes instead, e.g., of worker processes.
+
+    Returns
+    -------
+
+    peak : int
+        Peak RSS in KB ('None' if not available).
+    """
+
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on Mac OS X
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+def rss_kb():
+    """Get the current resident set size.
+
+    Returns
+    -------
+
+    rss : int
+        Current RSS in KB ('None' if not available, i.e., on
+        systems without /proc).
+    """
+
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as fid:
+            pages = int(fid.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+def _max_or_none(*values):
+    values = [v for v in values if not v is None]
+    return max(values) if len(values) else None
+
+
+class Profiler(object):
+    """Record per-stage timings, counters and memory usage of a run.
+
+    Example
+    -------
+
+    prof = Profiler()
+    with prof.stage('codebook'):
+        cb = fsa.learn_codebook(X)
+    prof.count('graphs', 10)
+    prof.write('/tmp/report.json')
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = OrderedDict()
+        self.counters = defaultdict(int)
+        self.info = {}
+
+    def _stage_record(self, name):
+        if not name in self.stages:
+            self.stages[name] = {'time' : 0.0,
+                                 'calls' : 0,
+                                 'rss_increase_kb' : None,
+                                 'process_peak_rss_kb_at_end' : None}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Time a (possibly repeated) stage.
+
+        Parameters
+        ----------
+
+        name : string
+            Stage name; times of repeated stages are accumulated.
+        """
+
+        rss0 = rss_kb()
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            rss1 = rss_kb()
+            rec = self._stage_record(name)
+            rec['time'] += elapsed
+            rec['calls'] += 1
+            # The peak RSS of the process is a high-water mark over its
+            # lifetime, so the stage's own memory is measured as the
+            # change of the current RSS (max. over calls)
+            if not rss0 is None and not rss1 is None:
+                rec['rss_increase_kb'] = _max_or_none(
+                    rec['rss_increase_kb'], rss1 - rss0)
+            rec['process_peak_rss_kb_at_end'] = peak_rss_kb()
+            logging.getLogger().debug("Stage %s : %.3f [sec]" %
+                                      (name, elapsed))
+
+    def count(self, name, n=1):
+        """Increment a counter.
+
+        Parameters
+        ----------
+
+        name : string
+            Counter name.
+
+        n : int (default : 1)
+            Increment.
+        """
+
+        self.counters[name] += n
+
+    def merge(self, report):
+        """Merge stages and counters of another profiler.
+
+        Parameters
+        ----------
+
+        report : dict
+            Output of 'report' of another Profiler, e.g., one that
+            ran in a worker process.
+        """
+
+        for name, other in report['stages'].items():
+            rec = self._stage_record(name)
+            rec['time'] += other['time']
+            rec['calls'] += other['calls']
+            for key in ('rss_increase_kb', 'process_peak_rss_kb_at_end'):
+                rec[key] = _max_or_none(rec[key], other[key])
+        for name, n in report['counters'].items():
+            self.counters[name] += n
+
+    def report(self):
+        """Build the run report.
+
+        Returns
+        -------
+
+        report : dict
+            Wall time, peak RSS (of this process and its children),
+            per-stage records (cumulative time, #calls, max. increase
+            of the current RSS during the stage and the peak RSS of
+            the process at the end of the stage), counters and
+            additional info.
+        """
+
+        return {'start' : time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(self.start_time)),
+                'wall_time' : time.time() - self.start_time,
+                'peak_rss_kb' : peak_rss_kb(),
+                'peak_rss_children_kb' : peak_rss_kb(children=True),
+                'stages' : self.stages,
+                'counters' : dict(self.counters),
+                'info' : self.info}
+
+    def write(self, filename):
+        """Write the run report as JSON.
+
+        Parameters
+        ----------
+
+        filename : string
+            Output file name.
+        """
+
+        with open(filename, 'w') as fid:
+            json.dump(self.report(), fid, indent=2)
@@ -15,6 +15,7 @@ import sys
 import logging
 import numpy as np
 from optparse import OptionParser
+from multiprocessing import Pool
 
 
 # Define the log levels
@@ -33,6 +34,10 @@ def _radii_callback(option,opt,value,parser):
     parser.values.radii = radii
 
 
+def _features_callback(option,opt,value,parser):
+    parser.values.features = [e.strip() for e in value.split(',')]
+
+
 def _globalLabelFile_callback(option,opt,value,parser):
     print value
     if value is None:
@@ -107,12 +112,30 @@ def setup_cli_parsing():
                       "--normalize",
                       action="store_true",
                       default=False,
-                      help="Enable feature normalization (mean/var).")
+                      help="Enable feature normalization (mean/var), "
+                           "estimated on the training data of each fold.")
+    parser.add_option("",
+                      "--memoryMap",
+                      action="store_true",
+                      default=False,
+                      help="Keep the feature matrix in a memory-mapped "
+                           "file (<writeAs>.npy).")
+    parser.add_option("",
+                      "--chunkSize",
+                      default=10000,
+                      type="int",
+                      help="number of feature vectors processed at a time "
+                           "(normalization, mini-batches).")
     parser.add_option("",
                       "--cvRuns",
                       default=5,
                       type="int",
                       help="number of cross-validations to run.")
+    parser.add_option("",
+                      "--jobs",
+                      default=1,
+                      type="int",
+                      help="number of worker processes.")
     parser.add_option("",
                       "--recompute",
                       action="store_true",
@@ -151,6 +174,10 @@ def setup_cli_parsing():
     parser.add_option("",
                       "--logTo",
                       help="Specify logging file.")
+    parser.add_option("",
+                      "--profileTo",
+                      help="Write a JSON run report (per-stage timings, "
+                           "counters, memory) to file.")
     parser.add_option("",
                       "--globalLabelFile",
                       type="string",
@@ -162,6 +189,19 @@ def setup_cli_parsing():
                       action='callback',
                       callback=_radii_callback,
                       help="list of neighborhood radi(i), e.g., 1,2,3")
+    parser.add_option("", "--sample",
+                      type="choice",
+                      choices=["uniform", "degree", "fps"],
+                      help="vertex sampling strategy (uniform, degree, fps).")
+    parser.add_option("", "--budget",
+                      type="int",
+                      help="max. number of sampled vertices per graph.")
+    parser.add_option("", "--features",
+                      type="string",
+                      action='callback',
+                      callback=_features_callback,
+                      help="list of FSA feature names (default: all), "
+                           "e.g., avg_degree,label_entropy")
     return parser
 
 
@@ -317,6 +357,77 @@ def read_group_info(options):
     return grp_info
 
 
+def fold_seed(seed, cv_id):
+    """Derive the seed of one cross-validation fold.
+
+    Parameters
+    ----------
+
+    seed : int
+        Global seed (e.g., the value of '--seed'), or 'None'.
+
+    cv_id : int
+        Index of the fold.
+
+    Returns
+    -------
+
+    seed : int
+        Seed for the fold, independent of the order in which the
+        folds are processed ('None' if no global seed is given).
+    """
+
+    if seed is None:
+        return None
+    return seed + cv_id
+
+
+def run_folds(fold_fun, cv, n_jobs=1, initializer=None, initargs=()):
+    """Run a function on each cross-validation fold.
+
+    Parameters
+    ----------
+
+    fold_fun : callable
+        Module-level function that takes a 3-tuple of (fold index,
+        training indices, testing indices) and returns the result
+        for that fold.
+
+    cv : iterable of (training indices, testing indices)
+        Cross-validation folds.
+
+    n_jobs : int (default : 1)
+        Number of worker processes. If 1, the folds are processed
+        serially in the calling process.
+
+    initializer : callable (default : None)
+        Called with 'initargs' once per worker process (or once in
+        the calling process if n_jobs is 1), e.g., to open a shared
+        read-only feature matrix.
+
+    initargs : tuple (default : ())
+        Arguments to 'initializer'.
+
+    Returns
+    -------
+
+    results : list
+        Results of 'fold_fun', in the order of the folds.
+    """
+
+    folds = [(cv_id, trn, tst) for cv_id, (trn, tst) in enumerate(cv)]
+    if n_jobs <= 1:
+        if not initializer is None:
+            initializer(*initargs)
+        return [fold_fun(fold) for fold in folds]
+
+    pool = Pool(n_jobs, initializer, initargs)
+    results = pool.map(fold_fun, folds)
+    pool.close()
+    pool.join()
+    return results
+
+
 def show_summary(scores):
     """Print a classification report to stdout.
 
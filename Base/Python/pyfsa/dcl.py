@@ -34,6 +34,107 @@ import os
 # pyfsa imports
 import core.fsa as fsa
 import core.utils as utils
+from core.profiling import Profiler
+
+
+# Data shared by all folds (set by '_init_fold_data')
+_fold_data = {}
+
+
+def _init_fold_data(data_mat, data_idx, data_off, class_info, options):
+    # Worker processes open the memory-mapped feature matrix by name
+    if isinstance(data_mat, str):
+        data_mat = np.load(data_mat, mmap_mode='r')
+    _fold_data.update(data_mat=data_mat,
+                      data_idx=data_idx,
+                      data_off=data_off,
+                      class_info=np.asarray(class_info),
+                      options=options,
+                      codebook=None)
+
+
+def evaluate_fold(fold):
+    """Evaluate the BoW/SVM classifier on one cross-validation fold.
+
+    Parameters
+    ----------
+
+    fold : 3-tuple of (fold index, training graphs, testing graphs)
+
+    Returns
+    -------
+
+    res : 4-tuple of (score, predicted labels, true labels, profiler
+        report of the fold)
+    """
+
+    cv_id, trn, tst = fold
+    data_mat = _fold_data['data_mat']
+    data_idx = _fold_data['data_idx']
+    data_off = _fold_data['data_off']
+    class_info = _fold_data['class_info']
+    options = _fold_data['options']
+    seed = utils.fold_seed(options.seed, cv_id)
+    prof = Profiler()
+
+    # Compose training data
+    np_pos = fsa.graph_rows(data_off, trn)
+
+    # Estimate feature normalization from training data
+    scaler = None
+    if options.normalize:
+        with prof.stage('normalize'):
+            scaler = fsa.fit_scaler(data_mat, np_pos, options.chunkSize)
+
+    # Learn a codebook from training data
+    with prof.stage('codebook'):
+        if options.miniBatch:
+            # Warm-start from the previous fold's codebook (serial only)
+            init = None
+            if options.jobs <= 1 and not _fold_data['codebook'] is None:
+                init = _fold_data['codebook'].cluster_centers_
+            codebook = fsa.learn_codebook_minibatch(data_mat,
+                                                    options.codewords,
+                                                    seed,
+                                                    np_pos,
+                                                    options.chunkSize,
+                                                    init=init,
+                                                    scaler=scaler)
+            _fold_data['codebook'] = codebook
+        else:
+            codebook = fsa.learn_codebook(fsa.take_rows(data_mat,
+                                                        np_pos,
+                                                        scaler,
+                                                        options.chunkSize),
+                                          options.codewords,
+                                          seed)
+
+    # Compute BoW histograms for training data
+    with prof.stage('bow'):
+        bow_trn_mat = fsa.bow_batch(data_mat, data_idx, codebook, trn,
+                                    options.chunkSize, scaler)
+
+    # Cross-validate (5-fold) SVM classifier and parameters
+    param_selection = [{'kernel': ['rbf'],
+                        'gamma': np.logspace(-6,2,10),
+                        'C': [1, 10, 100, 1000]},
+                       {'kernel': ['linear'],
+                        'C': [1, 10, 100, 1000]}]
+    clf = GridSearchCV(svm.SVC(C=1), param_selection, cv=5)
+    with prof.stage('fit'):
+        clf.fit(bow_trn_mat, class_info[trn])
+
+    # Compute BoW histograms for testing data
+    with prof.stage('bow'):
+        bow_tst_mat = fsa.bow_batch(data_mat, data_idx, codebook, tst,
+                                    options.chunkSize, scaler)
+
+    # Score the classifier
+    with prof.stage('predict'):
+        yhat = clf.predict(bow_tst_mat)
+    score = np.mean(yhat == class_info[tst])
+    prof.count('folds')
+    return score, yhat, class_info[tst], prof.report()
 
 
 def main(argv=None):
@@ -47,11 +148,18 @@ def main(argv=None):
                       help="number of codewords.",
                       default=50,
                       type="int")
+    parser.add_option("",
+                      "--miniBatch",
+                      action="store_true",
+                      default=False,
+                      help="Learn codebooks with mini-batch K-Means "
+                           "(warm-started across folds if --jobs=1).")
     (options, args) = parser.parse_args()
 
     # Setup logging
     utils.setup_logging(options)
     logger = logging.getLogger()
+    prof = Profiler()
 
     # Read graph file list and label file list
     graph_file_list = utils.read_graph_file_list(options)
@@ -81,9 +189,16 @@ def main(argv=None):
                           options.recompute,
                           options.writeAs,
                           options.skip,
-                          options.omitDegenerate)
+                          options.omitDegenerate,
+                          options.features,
+                          options.memoryMap,
+                          options.sample,
+                          options.budget,
+                          options.seed,
+                          prof)
     data_mat = fsa_res['data_mat']
     data_idx = fsa_res['data_idx']
+    data_off = fsa_res['data_off']
 
     # Create cross-validation folds
     n_graphs = len(class_info)
@@ -92,60 +207,37 @@ def main(argv=None):
                       test_size=0.2,
                       random_state=0)
 
-    # Try inplace feature normalization
-    if options.normalize:
-        logger.info("Running feature normalization ...")
-        scaler = preprocessing.StandardScaler(copy=False)
-        scaler.fit_transform(fsa_res['data_mat'])
+    # Share the feature matrix with the worker processes
+    if options.jobs > 1:
+        if not options.memoryMap:
+            data_mat = fsa.memmap_features(data_mat,
+                                           "%s.npy" % options.writeAs)
+        data_mat = data_mat.filename
+
+    # Evaluate the folds (concurrently, if --jobs > 1)
+    results = utils.run_folds(evaluate_fold,
+                              cv,
+                              options.jobs,
+                              _init_fold_data,
+                              (data_mat, data_idx, data_off, class_info,
+                               options))
 
     scores = []
-    for cv_id, (trn, tst) in enumerate(cv):
-
-        # Compose training data
-        pos = []
-        for i in trn:
-            tmp = np.where(data_idx==i)[0]
-            pos.extend(list(tmp))
-        np_pos = np.array(pos)
-
-        # Learn a codebook from training data
-        codebook = fsa.learn_codebook(data_mat[np_pos,:],
-                                      options.codewords,
-                                      options.seed)
-
-        # Compute BoW histograms for training data
-        bow_trn_mat = np.zeros((len(trn), options.codewords))
-        for cnt, i in enumerate(trn):
-            np_pos = np.where(data_idx==i)[0]
-            bow_trn_mat[cnt,:] = np.asarray(fsa.bow(data_mat[np_pos,:],
-                                                    codebook))
-
-        # Cross-validate (5-fold) SVM classifier and parameters
-        param_selection = [{'kernel': ['rbf'],
-                            'gamma': np.logspace(-6,2,10),
-                            'C': [1, 10, 100, 1000]},
-                           {'kernel': ['linear'],
-                            'C': [1, 10, 100, 1000]}]
-        clf = GridSearchCV(svm.SVC(C=1), param_selection)
-        clf.fit(bow_trn_mat, np.asarray(class_info)[trn], cv=5)
-
-        # Compute BoW histograms for testing data
-        bow_tst_mat = np.zeros((len(tst), options.codewords))
-        for cnt,i in enumerate(tst):
-            pos =  np.where(data_idx==i)[0]
-            bow_tst_mat[cnt,:] = fsa.bow(data_mat[pos,:], codebook)
-
-        print "yhat : ", clf.predict(bow_tst_mat)
-        print "gold : ", np.asarray(class_info)[tst]
-
-        # Score the classifier
-        score = clf.score(bow_tst_mat, np.asarray(class_info)[tst])
-        scores.append(score)
+    for cv_id, (score, yhat, gold, fold_report) in enumerate(results):
+        logger.info("yhat : %s" % yhat)
+        logger.info("gold : %s" % gold)
 
+        scores.append(score)
+        prof.merge(fold_report)
         logger.info("Score (%.2d): %.2f" % (cv_id,100*score))
 
     utils.show_summary(scores)
 
+    if not options.profileTo is None:
+        prof.info['feature_timings'] = fsa_res['feature_timings']
+        prof.info['scores'] = [float(score) for score in scores]
+        prof.write(options.profileTo)
+
 
 if __name__ == "__main__":
     main()
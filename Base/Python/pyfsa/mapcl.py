@@ -34,6 +34,7 @@ import os
 # Fine-structure analysis
 import core.fsa as fsa
 import core.utils as utils
+from core.profiling import Profiler
 
 
 def main(argv=None):
@@ -52,6 +53,7 @@ def main(argv=None):
     # Setup logging
     utils.setup_logging(options)
     logger = logging.getLogger()
+    prof = Profiler()
 
     # Read graph file list and label file list
     graph_file_list = utils.read_graph_file_list(options)
@@ -77,9 +79,16 @@ def main(argv=None):
                           options.recompute,
                           options.writeAs,
                           options.skip,
-                          options.omitDegenerate)
+                          options.omitDegenerate,
+                          options.features,
+                          options.memoryMap,
+                          options.sample,
+                          options.budget,
+                          options.seed,
+                          prof)
     data_mat = fsa_res['data_mat']
     data_idx = fsa_res['data_idx']
+    data_off = fsa_res['data_off']
 
     # Create cross-validation folds (20% testing)
     n_graphs = len(class_info)
@@ -91,47 +100,73 @@ def main(argv=None):
     # Our unique class labels
     label_set = np.unique(class_info)
 
-    if options.normalize:
-        logger.info("Running feature normalization ...")
-        scaler = preprocessing.StandardScaler(copy=False)
-        scaler.fit_transform(fsa_res['data_mat'])
+    # Share the feature matrix with the worker processes
+    if options.jobs > 1 and not options.memoryMap:
+        data_mat = fsa.memmap_features(data_mat, "%s.npy" % options.writeAs)
+
+    # Collect the training rows of each class in each fold
+    folds = list(cv)
+    row_sets, seeds, scalers = [], [], []
+    for cv_id, (trn, tst) in enumerate(folds):
+        # Estimate feature normalization from training data
+        scaler = None
+        if options.normalize:
+            with prof.stage('normalize'):
+                scaler = fsa.fit_scaler(data_mat,
+                                        fsa.graph_rows(data_off, trn),
+                                        options.chunkSize)
 
-    scores = []
-    for cv_id, (trn, tst) in enumerate(cv):
-
-        models = []
         for l in label_set:
             l_idx = np.where(class_info == l)[0]
             l_idx = np.asarray(l_idx).ravel()
             l_trn = np.intersect1d(l_idx, trn)
+            row_sets.append(fsa.graph_rows(data_off, l_trn))
+            seeds.append(utils.fold_seed(options.seed, cv_id))
+            scalers.append(scaler)
+
+    # Estimate all class models of all folds concurrently
+    with prof.stage('fit'):
+        all_models = fsa.estimate_gm_parallel(data_mat,
+                                              row_sets,
+                                              options.mixComp,
+                                              seeds,
+                                              options.jobs,
+                                              scalers)
+    prof.count('models', len(all_models))
 
-            pos = []
-            for i in l_trn:
-                tmp = np.where(fsa_res['data_idx']==i)[0]
-                pos.extend(list(tmp))
+    scores = []
+    n_labels = len(label_set)
+    for cv_id, (trn, tst) in enumerate(folds):
 
-            np_pos = np.asarray(pos)
-            gmm_model = fsa.estimate_gm(data_mat[np_pos,:], options.mixComp)
-            models.append(gmm_model)
+        models = all_models[cv_id*n_labels:(cv_id+1)*n_labels]
 
-        predict = []
-        for i in tst:
-            pos = np.where(data_idx==i)[0]
-            map_idx = fsa.pp_gmm(data_mat[pos,:], models, argmax=True)
-            predict.append(label_set[map_idx])
+        # MAP classification of all testing graphs at once
+        pos, tst_off = fsa.graph_rows(data_off, tst, return_offsets=True)
+        with prof.stage('predict'):
+            X_tst = fsa.take_rows(data_mat, pos, scalers[cv_id*n_labels],
+                                  options.chunkSize)
+            map_idx = fsa.pp_gmm_batch(X_tst, models, tst_off,
+                                       n_jobs=options.jobs)
+        predict = list(label_set[map_idx])
+        prof.count('folds')
 
         # Score the MAP classifier
         truth = [class_info[i] for i in tst]
         score = accuracy_score(truth, predict)
 
-        print "yhat :", predict
-        print "gold :", truth
+        logger.info("yhat : %s" % predict)
+        logger.info("gold : %s" % truth)
 
         logger.info("Score (%.2d): %.2f" % (cv_id, 100*score))
         scores.append(score)
 
     utils.show_summary(scores)
 
+    if not options.profileTo is None:
+        prof.info['feature_timings'] = fsa_res['feature_timings']
+        prof.info['scores'] = [float(score) for score in scores]
+        prof.write(options.profileTo)
+
 
 if __name__ == "__main__":
     main()
@@ -24,16 +24,18 @@
 
 from ctypes import *
 from collections import namedtuple
-
-import Image
+from collections import OrderedDict
 
 import numpy as np
 
 import scipy as sp
 import scipy.ndimage
-import scipy.stats.mstats
 
 import math
+import time
+import itertools
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 class POINTF( Structure ):
      _fields_ = [( "x", c_float ),
@@ -77,12 +79,24 @@ def wienerFilter( array1, maskSize ):
     return wienerFilteredImage
 
 
-def gaussianFilter( array1, sigma ):
+def gaussianFilter( array1, sigma, out=None, want_highpass=True,
+                    dtype=None ):
     """
         Apply gaussian filter to a given array
+        The low-pass image is written to out, if given, or else computed in
+        dtype (default: type of array1, e.g., np.float32 halves the memory
+        of float64). The high-pass image is None if not want_highpass
     """
-    gauss_lowpass = sp.ndimage.gaussian_filter( array1, sigma )
-    gauss_highpass = array1 - gauss_lowpass
+    if out is None:
+        gauss_lowpass = sp.ndimage.gaussian_filter( array1, sigma,
+            output=dtype )
+    else:
+        sp.ndimage.gaussian_filter( array1, sigma, output=out )
+        gauss_lowpass = out
+
+    gauss_highpass = None
+    if want_highpass:
+        gauss_highpass = array1 - gauss_lowpass
 
     return gauss_lowpass, gauss_highpass
 
@@ -112,27 +126,115 @@ def highPassFilter( array1 ):
     highpass_5x5 = sp.ndimage.convolve( array1, kernel )
 
 
-def threshold( inputImage, edge_threshold, lowVal=0, highVal=255 ):
-
-   thresholdedImage1 = sp.stats.mstats.threshold( inputImage, None,
-     edge_threshold,  highVal )
+def threshold( inputImage, edge_threshold, lowVal=0, highVal=255, out=None,
+               blockSize=1048576 ):
+    """
+        Sets values above edge_threshold to highVal and all others to lowVal
+        (as before, highVal itself becomes lowVal if it is not above
+        edge_threshold + 1e-11, and NaNs are kept). The result has the
+        type of inputImage and is written to out, if given (e.g.,
+        inputImage itself or a np.memmap), in blocks of about blockSize
+        values along the first axis
+    """
+    inputImage = np.asarray( inputImage )
+    if out is None:
+        out = np.empty( inputImage.shape, dtype=inputImage.dtype )
+
+    lowVal = np.asarray( lowVal ).astype( inputImage.dtype )
+    highVal = np.asarray( highVal ).astype( inputImage.dtype )
+    if not highVal >= edge_threshold+0.00000000001:
+        highVal = lowVal
+
+    if inputImage.ndim == 0:
+        out[...] = np.where( inputImage > edge_threshold, highVal, lowVal )
+        return out
+
+    rowSize = max( int( np.prod( inputImage.shape[1:] ) ), 1 )
+    blockRows = max( blockSize // rowSize, 1 )
+    for start in range( 0, len( inputImage ), blockRows ):
+        block = inputImage[start:start+blockRows]
+        thresholdedBlock = np.where( block > edge_threshold, highVal,
+            lowVal )
+        if inputImage.dtype.kind in 'fc':
+            np.copyto( thresholdedBlock, block, where=np.isnan( block ) )
+        out[start:start+blockRows] = thresholdedBlock
+
+    return out
+
+def _valueHistogram( x, exact=False, nBins=4096 ):
+    """
+        Histogram of the values in x as (bin values, bin counts), where
+        the bin value is the mean of the values in that bin. Integer
+        images (value range < 65536) and exact mode use one bin per
+        distinct value
+    """
+    x = x.ravel()
+    if x.dtype == bool:
+        x = x.view( np.uint8 )
+    xMin = x.min()
+    xMax = x.max()
+
+    if x.dtype.kind in 'iu' and float( xMax ) - float( xMin ) < 65536:
+        # Offsets from the minimum (signed types would overflow in place)
+        if x.dtype.kind == 'i':
+            offsets = x.astype( np.int64 ) - int( xMin )
+        else:
+            offsets = x - xMin
+        counts = np.bincount( offsets.astype( np.intp ) )
+        values = np.arange( len( counts ) ) + float( xMin )
+    elif exact or xMax == xMin:
+        values, counts = np.unique( x, return_counts=True )
+        values = values.astype( float )
+    else:
+        scale = nBins / ( float( xMax ) - float( xMin ) )
+        binIndex = ( ( x - float( xMin ) ) * scale ).astype( np.intp )
+        np.clip( binIndex, 0, nBins-1, out=binIndex )
+        counts = np.bincount( binIndex, minlength=nBins )
+        sums = np.bincount( binIndex, weights=x, minlength=nBins )
+        nonEmpty = counts > 0
+        counts = counts[nonEmpty]
+        values = sums[nonEmpty] / counts
+
+    nonEmpty = counts > 0
+    return values[nonEmpty], counts[nonEmpty]
+
+def thresholdBinary( x, T, delta=1e-3, minval=1, maxval=0, exact=False,
+                     nBins=4096 ):
+    """
+        Iterative (isodata) thresholding, starting at T
 
-   thresholdedImage2 = sp.stats.mstats.threshold( thresholdedImage1,
-     edge_threshold+0.00000000001, None, lowVal )
+        The class means are computed from a histogram of x that is built
+        once, so each iteration only visits the bins. Integer images and
+        exact mode use one bin per distinct value (same result as
+        iterating over all pixels); otherwise, float images use nBins bins.
+        Returns the binary image (minval where x <= T) and T.
+    """
+    x = np.asarray( x )
+    values, counts = _valueHistogram( x, exact, nBins )
 
-   return thresholdedImage2
+    cumCounts = np.cumsum( counts )
+    cumSums = np.cumsum( values * counts )
+    totalCount = cumCounts[-1]
+    totalSum = cumSums[-1]
 
-def thresholdBinary( x, T, delta=1e-3, minval=1, maxval=0 ):
-    x = np.asarray( x ).copy()
     Told = T + 1
     while np.abs( T - Told ) > delta:
         Told = T
-        mask = ( x<=T )
-        T = ( x[mask].mean() + x[~mask].mean() )/2.
-
-    x[mask] = minval
-    x[~mask] = maxval
-    return x, T
+        # Number of bins <= T
+        k = np.searchsorted( values, T, side='right' )
+        lowCount = cumCounts[k-1] if k > 0 else 0
+        lowSum = cumSums[k-1] if k > 0 else 0.
+        highCount = totalCount - lowCount
+        lowMean = lowSum / lowCount if lowCount > 0 else np.nan
+        highMean = ( ( totalSum - lowSum ) / highCount if highCount > 0
+                     else np.nan )
+        T = ( lowMean + highMean )/2.
+
+    # As before, the mask stems from the threshold of the last iteration
+    binary = np.empty( x.shape, dtype=x.dtype )
+    binary.fill( maxval )
+    binary[x <= Told] = minval
+    return binary, T
 
 _4_connected = np.array( [[0, 1, 0],
                          [1, 1, 1],
@@ -144,54 +246,55 @@ _8_connected = np.array( [[1, 1, 1],
 
 def removeSmallRegionBlobs( inputImage, regionThreshold ):
 
+    fullyConnected = sp.ndimage.generate_binary_structure( inputImage.ndim,
+      inputImage.ndim )
     prunedImage1 = removeSmallSizes( inputImage, regionThreshold,
-      structure=_8_connected )
+      structure=fullyConnected )
 
-    prunedImage2= removeSmallSizes( prunedImage1, regionThreshold,
-      structure=_4_connected )
+    prunedImage2= removeSmallSizes( prunedImage1, regionThreshold )
 
     return prunedImage2
 
-def removeSmallSizes( inputImage, minSize, structure=_4_connected ):
-
-   labelImage, num_objects = sp.ndimage.label( inputImage, structure )
+def _regionSizes( inputImage, labelImage ):
+    """
+        Size of each labeled region (index 0 is the background),
+        weighted by inputImage / inputImage.max() for non-binary images
+    """
+    if inputImage.dtype == bool:
+        return np.bincount( labelImage.ravel() )
+    weights = inputImage / inputImage.max()
+    return np.bincount( labelImage.ravel(), weights=weights.ravel() )
 
-   objectLabels = np.arange( 1, num_objects+1 )
+def removeSmallSizes( inputImage, minSize, structure=None ):
+   """
+        Keep the connected regions with at least minSize pixels (N-D);
+        structure defaults to face connectivity (4-connected in 2D)
+   """
 
    if( inputImage.max() == 0 ):
     return inputImage
 
-   areas = np.array( sp.ndimage.sum( inputImage / inputImage.max(), labelImage,
-                                  objectLabels ) )
-
-   bigObjects = objectLabels[areas >= minSize]
-
-   bigObjectImage = np.zeros( inputImage.shape, dtype=bool )
+   labelImage, num_objects = sp.ndimage.label( inputImage, structure )
 
-   for bo in bigObjects:
-     bigObjectImage |= labelImage == bo
+   # Lookup table: label -> keep
+   keep = _regionSizes( inputImage, labelImage ) >= minSize
+   keep[0] = False
 
-   return bigObjectImage
+   return keep[labelImage]
 
 def getLargestRegionBlob( inputImage ):
 
-   labelImage, num_objects = sp.ndimage.label( inputImage )
-   objectLabels = np.arange( 1, num_objects+1 )
-
    if( inputImage.max() == 0 ):
     return inputImage
 
-   areas = np.array( sp.ndimage.sum( inputImage / inputImage.max(),
-                                     labelImage, objectLabels ) )
-   max_size = sp.ndimage.maximum( areas )
-
-   bigObjects = objectLabels[areas == max_size]
+   labelImage, num_objects = sp.ndimage.label( inputImage )
 
-   bigObjectImage = np.zeros( inputImage.shape, dtype=bool )
-   for bo in bigObjects:
-     bigObjectImage |= labelImage == bo
+   # Lookup table: label -> keep (all regions of maximum size)
+   areas = _regionSizes( inputImage, labelImage )
+   keep = areas == areas[1:].max()
+   keep[0] = False
 
-   return bigObjectImage
+   return keep[labelImage]
 
 def findConnectedComponents( inputImage ):
     """
@@ -208,17 +311,32 @@ def scale( array1 ):
     array2 = normalize( array1 )
     return array2 * 255
 
-def scaleUsingFullWidthHalfMax( array1, stdDevScale=10 ):
+def scaleUsingFullWidthHalfMax( array1, stdDevScale=10, sampleSize=None,
+                                sampleMethod='strided', seed=None,
+                                inPlace=False ):
     """
         Scales the values in array to be between 0 and 255
+        (see normalizeUsingFullWidthHalfMax for the sampling options).
+        With inPlace, a float array1 is overwritten by the result
     """
-    array2 = normalizeUsingFullWidthHalfMax( array1, False )
+    meanV, stdDevV = _estimateFullWidthHalfMax( array1, False, sampleSize,
+        sampleMethod, seed )
 
-    array2 = (array2 * stdDevScale) + ( 128 * np.ones( array2.shape ) )
-    array2 = array2.clip( min=0, max=255 )
+    if inPlace and array1.dtype.kind == 'f':
+        array2 = array1
+    else:
+        array2 = array1.astype( float )
+    _scaleInPlace( array2, meanV, stdDevV, stdDevScale )
 
     return array2
 
+def _scaleInPlace( array2, meanV, stdDevV, stdDevScale ):
+    array2 -= meanV
+    array2 /= stdDevV
+    array2 *= stdDevScale
+    array2 += 128
+    np.clip( array2, 0, 255, out=array2 )
+
 def getNMax( arr, n ):
     """
 
@@ -235,7 +353,34 @@ def normalize( array1 ):
     maximum = float( array1.max() )
     return array1 / maximum
 
-def normalizeUsingFullWidthHalfMax( array, isArrayOfInts ):
+def _sampleValues( array, sampleSize, sampleMethod='strided', seed=None ):
+    """
+        Returns at least sampleSize values of array, taken on a regular
+        grid with the same step along each axis ('strided', a view of
+        array), or about sampleSize values at random ('random')
+    """
+    array = np.asarray( array )
+    if sampleSize is None or array.size <= sampleSize:
+        return array
+    if sampleMethod == 'strided':
+        # Stepping through the flattened array instead would alias onto a
+        # few columns
+        step = int( ( array.size / float( sampleSize ) )
+            ** ( 1.0 / array.ndim ) )
+        return array[( slice( None, None, max( step, 1 ) ), ) * array.ndim]
+    elif sampleMethod == 'random':
+        rng = np.random.RandomState( seed )
+        return np.take( array, rng.randint( 0, array.size, sampleSize ) )
+    raise ValueError( "Unknown sampling method '%s'" % sampleMethod )
+
+def _estimateFullWidthHalfMax( array, isArrayOfInts, sampleSize=None,
+                               sampleMethod='strided', seed=None ):
+    """
+        Estimates mean and standard deviation of the main mode of the
+        histogram of array from its full width at half maximum
+    """
+    array = _sampleValues( array, sampleSize, sampleMethod, seed )
+
     nBins = 50
     binMin = array.min()
     binMax = array.max()
@@ -257,20 +402,21 @@ def normalizeUsingFullWidthHalfMax( array, isArrayOfInts ):
 
         maxBinV = bins.max()
         maxBinList = sp.transpose( ( bins == maxBinV ).nonzero() )[0]
-        maxBin = maxBinList[ len(maxBinList)/2 ]
+        maxBin = maxBinList[ len(maxBinList)//2 ]
 
         fwhm = maxBinV / 2
 
-        binFWHMMin = maxBin
-        while binFWHMMin > 0 and bins[ binFWHMMin ] >= fwhm:
-            binFWHMMin -= 1
+        # Last bin below half max. left of the peak, first one right of it
+        belowFWHM = bins < fwhm
+        left = np.flatnonzero( belowFWHM[:maxBin+1] )
+        right = np.flatnonzero( belowFWHM[maxBin:] )
+
+        binFWHMMin = left[-1] if len( left ) else 0
         denom = ( bins[ binFWHMMin+1 ] - bins[ binFWHMMin ] )
         if denom != 0:
             binFWHMMin += ( ( fwhm - bins[ binFWHMMin ] ) / denom )
 
-        binFWHMMax = maxBin
-        while binFWHMMax < nBins-1 and bins[ binFWHMMax ] >= fwhm:
-            binFWHMMax += 1
+        binFWHMMax = maxBin + right[0] if len( right ) else nBins-1
         denom = ( bins[ binFWHMMax-1 ] - bins[ binFWHMMax ] )
         if denom != 0:
             binFWHMMax -= ( ( fwhm - bins[ binFWHMMax ] ) / denom )
@@ -290,10 +436,32 @@ def normalizeUsingFullWidthHalfMax( array, isArrayOfInts ):
         #   http://mathworld.wolfram.com/GaussianFunction.html
         stdDevV = ( maxV - minV ) / 2.3548
 
+        if not stdDevV > 0:
+            # Constant values (e.g., a sample of the image border only):
+            # only subtract the mean
+            stdDevV = 1.0
+            break
+
         binMin = meanV - 3 * stdDevV
         binMax = meanV + 3 * stdDevV
 
-    return ( array.astype(float) - meanV ) / stdDevV
+    return meanV, stdDevV
+
+def normalizeUsingFullWidthHalfMax( array, isArrayOfInts, sampleSize=None,
+                                    sampleMethod='strided', seed=None ):
+    """
+        Normalizes the values in an array by the mean and standard deviation
+        of its main histogram mode, estimated from the full width at half
+        maximum. For large arrays, the estimate can be computed from a
+        sample of sampleSize values ('strided' or 'random' with seed)
+    """
+    meanV, stdDevV = _estimateFullWidthHalfMax( array, isArrayOfInts,
+        sampleSize, sampleMethod, seed )
+
+    normalized = np.asarray( array ).astype( float )
+    normalized -= meanV
+    normalized /= stdDevV
+    return normalized
 
 def extractSubImage( inputImage, center, mask ):
     """
@@ -328,55 +496,144 @@ def extractSubImage( inputImage, center, mask ):
     return inputImage[corner[0,1]:corner[1,1],corner[1,0]:corner[2,0]], corner
 
 
-def cropLargestBinaryRegion( inputImage ):
+def _windowView( inputImage, patchSize ):
+    """
+        View of all patches of patchSize in inputImage, indexed by the
+        patch start (zero-copy, like numpy's sliding_window_view)
+    """
+    shape = ( tuple( n-p+1 for n, p in zip( inputImage.shape, patchSize ) )
+        + tuple( patchSize ) )
+    return np.lib.stride_tricks.as_strided( inputImage, shape=shape,
+        strides=inputImage.strides * 2 )
 
-    B = np.argwhere( inputImage )
-    ( ystart, xstart ), ( ystop, xstop ) = B.min( 0 ), B.max( 0 ) + 1
-    Atrim = inputImage[ystart:ystop, xstart:xstop]
+def extractSubImages( inputImage, centers, patchSize, padMode=None,
+                      returnView=False, **padArgs ):
+    """
+        Extracts the patches of size patchSize (an int or one size per
+        axis) around each of the centers, an N x ndim array of indices
+        into inputImage (e.g., row, column in 2D), at once
+        Patches that cross the image border are shifted into the image
+        (padMode None) or read from the image padded by
+        np.pad( inputImage, ..., mode=padMode, **padArgs ), which is only
+        done if needed. Returns the N x patchSize stack of patches (a copy,
+        gathered in one step) and the N x ndim patch starts
+        With returnView, the stack is not gathered; instead, the zero-copy
+        window view of the image (of the padded image, if padding was
+        needed) is returned with the starts into it, i.e., patch i is
+        view[ tuple( starts[i] ) ]
+    """
+    inputImage = np.asarray( inputImage )
+    ndim = inputImage.ndim
+    if np.isscalar( patchSize ):
+        patchSize = ( patchSize, ) * ndim
+    patchSize = np.asarray( patchSize, dtype=np.intp )
+    shape = np.asarray( inputImage.shape, dtype=np.intp )
+    centers = np.asarray( centers, dtype=np.intp ).reshape( -1, ndim )
+
+    starts = centers - patchSize // 2
+    if len( starts ) == 0 and not returnView:
+        return ( np.empty( ( 0, ) + tuple( patchSize ),
+            dtype=inputImage.dtype ), starts )
+
+    image = inputImage
+    offset = np.zeros( ndim, dtype=np.intp )
+    if padMode is None:
+        if ( patchSize > shape ).any():
+            raise ValueError( "Patch size exceeds the image size" )
+        starts = np.clip( starts, 0, shape - patchSize )
+    elif len( starts ):
+        before = np.maximum( -starts.min( axis=0 ), 0 )
+        after = np.maximum( ( starts + patchSize ).max( axis=0 ) - shape, 0 )
+        if before.any() or after.any():
+            image = np.pad( inputImage, list( zip( before, after ) ),
+                mode=padMode, **padArgs )
+            offset = before
+
+    windows = _windowView( image, patchSize )
+    if returnView:
+        return windows, starts + offset
+    patches = windows[ tuple( ( starts + offset ).T ) ]
+    return patches, starts
+
+def _boundingBox( inputImage ):
+    """
+        Slices of the bounding box of the nonzero values of inputImage,
+        found in one pass (find_objects) without a coordinate array
+    """
+    mask = inputImage if inputImage.dtype == bool else inputImage != 0
+    box = sp.ndimage.find_objects( mask.view( np.uint8 ), max_label=1 )[0]
+    if box is None:
+        raise ValueError( "Image has no nonzero values" )
+    return box
 
-    cropMin = POINT( xstart, ystart )
-    cropMax = POINT( xstop, ystop )
+def cropLargestBinaryRegion( inputImage ):
+    """
+        Crops inputImage to the bounding box of its nonzero values
+        Returns the crop and the min./max. (exclusive) corners as POINT
+        (x: column, y: row) or, for 3D (z, y, x) volumes, as POINT3D
+    """
+    box = _boundingBox( inputImage )
+    Atrim = inputImage[box]
 
-    return Atrim, cropMin, cropMax
+    start = [ s.start for s in reversed( box ) ]
+    stop = [ s.stop for s in reversed( box ) ]
+    if inputImage.ndim == 2:
+        return Atrim, POINT( *start ), POINT( *stop )
+    elif inputImage.ndim == 3:
+        return Atrim, POINT3D( *start ), POINT3D( *stop )
+    raise ValueError( "Only 2D and 3D images are supported" )
 
 def cropImageByRegion( inputImage, minColumn, maxColumn, minRow, maxRow ):
     croppedImage = inputImage[minColumn:maxColumn,minRow:maxRow]
     return croppedImage
 
-def floodfill(inputImage, seed, threshMin, threshMax, return_region = False):
+def _connectivityStructure( ndim, connectivity=None ):
+    """
+        Get the structuring element of a 4/8 (2D) or 6/18/26 (3D)
+        neighborhood; defaults to face connectivity (4 or 6)
+    """
+    if connectivity is None:
+        return sp.ndimage.generate_binary_structure( ndim, 1 )
+
+    ranks = { 2: { 4: 1, 8: 2 },
+              3: { 6: 1, 18: 2, 26: 3 } }
+    try:
+        rank = ranks[ndim][connectivity]
+    except KeyError:
+        raise ValueError( "Connectivity %s not supported for %dD images"
+                          % ( connectivity, ndim ) )
+    return sp.ndimage.generate_binary_structure( ndim, rank )
+
+def floodfill(inputImage, seed, threshMin, threshMax, return_region = False,
+              connectivity=None):
     """
     Fill bounded region
 
-    "value" should be a value that otherwise does not occur within the image.
+    Returns the mask of all pixels with values in [threshMin, threshMax]
+    that are connected to the seed (2D or 3D). The seed itself is part
+    of the region only if it is in range and has an in-range neighbor.
+    connectivity is 4 or 8 (2D), 6, 18 or 26 (3D); default is 4 or 6.
+
+    With return_region, also returns the list of region coordinates,
+    starting with the seed.
     """
 
-    x, y = seed
+    seed = tuple( seed )
 
-    mask = np.zeros( inputImage.shape, dtype=bool )
+    inRange = ( inputImage >= threshMin ) & ( inputImage <= threshMax )
+    seedInRange = inRange[seed]
 
-    if return_region:
-        roi = [ (x, y) ]
-
-    edge = [ (x, y) ]
-    while edge:
-        newedge = []
-        for (x, y) in edge:
-            for (s, t) in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
-                try:
-                    item = inputImage[s, t]
-                except IndexError:
-                    pass
-                else:
-                    itemB = mask[s, t]
-                    if ( item >= threshMin and item <= threshMax and
-                         itemB == False ):
-                        mask[s, t] = True
-                        newedge.append((s, t))
-                        if return_region and not (s, t) in roi:
-                            roi.append( (s, t) )
-        edge = newedge
+    # Grow from the seed's neighbors, whether or not the seed is in range
+    inRange[seed] = True
+    structure = _connectivityStructure( inputImage.ndim, connectivity )
+    labelImage, num_objects = sp.ndimage.label( inRange, structure )
+    mask = labelImage == labelImage[seed]
+    mask[seed] = seedInRange and np.count_nonzero( mask ) > 1
 
     if return_region:
+        coords = np.argwhere( mask )
+        coords = coords[np.any( coords != seed, axis=1 )]
+        roi = [ seed ] + [ tuple( c ) for c in coords.tolist() ]
         return mask, roi
 
     return mask
@@ -384,11 +641,17 @@ def floodfill(inputImage, seed, threshMin, threshMax, return_region = False):
 def cropImage( inputImage, roiMinThreshold, roiMaxThreshold ):
     '''
        Hack method to find a dark box within a bright boarder
+       3D (z, y, x) volumes are cropped to the box of the largest region
     '''
     imageT = (inputImage >= roiMinThreshold) & (inputImage <= roiMaxThreshold)
     imageC = getLargestRegionBlob( imageT )
     imageT, cropMin, cropMax = cropLargestBinaryRegion( imageC )
 
+    if inputImage.ndim == 3:
+        croppedImage = inputImage[ cropMin.z:cropMax.z, cropMin.y:cropMax.y,
+            cropMin.x:cropMax.x ]
+        return croppedImage, cropMin, cropMax
+
     minRow = cropMin.y
     maxRow = cropMax.y
     minColumn = cropMin.x
@@ -401,27 +664,355 @@ def cropImage( inputImage, roiMinThreshold, roiMaxThreshold ):
 
     return croppedImage, minCoord, maxCoord
 
-def removeNoise( inputImage, noiseSize ):
+def removeNoise( inputImage, noiseSize, out=None, dtype=None ):
     #opSize = int( noiseSize / 2 )
     #deNoised1 = sp.ndimage.grey_opening( inputImage,
         #size=(opSize*2+1, opSize*2+1) )
     #deNoised2 = sp.ndimage.grey_closing( deNoised1,
         #size=(opSize*2+1, opSize*2+1) )
     #smoothedImage, tmp = gaussianFilter( deNoised2, noiseSize/3 )
-    smoothedImage, tmp = gaussianFilter( inputImage, noiseSize/3 )
+    smoothedImage, tmp = gaussianFilter( inputImage, noiseSize/3, out=out,
+        want_highpass=False, dtype=dtype )
     return smoothedImage
 
-def findBackground( inputImage, backgroundScale ):
-    background, tmp = gaussianFilter( inputImage, backgroundScale )
+def findBackground( inputImage, backgroundScale, out=None, dtype=None ):
+    background, tmp = gaussianFilter( inputImage, backgroundScale, out=out,
+        want_highpass=False, dtype=dtype )
     return background
 
-def divideImages( image1, image2 ):
-    return np.divide( image1, image2 )
+def divideImages( image1, image2, out=None ):
+    return np.divide( image1, image2, out=out )
+
+def removeBackground( inputImage, backgroundScale, noiseSize=1,
+                      sampleSize=None, out=None, dtype=None,
+                      backgroundOut=None ):
+    """
+        Divides the (denoised) image by its background and scales it by
+        the FWHM of the result. By default, the image is denoised in its
+        own type and processed in float64; with out (or dtype, e.g.,
+        np.float32) all steps are computed in that buffer (or type).
+        The background is computed in backgroundOut, if given (of the
+        type of the processed image)
+    """
+    smoothedImage = removeNoise( inputImage, noiseSize/2, out=out,
+        dtype=dtype )
+    if out is None and dtype is None:
+        smoothedImage = smoothedImage.astype( float )
+    backgroundImage = findBackground( smoothedImage, backgroundScale,
+        out=backgroundOut )
+    inputImageCleaned = divideImages( smoothedImage, backgroundImage,
+        out=smoothedImage )
+    inputImageCleaned = scaleUsingFullWidthHalfMax( inputImageCleaned, 3,
+        sampleSize=sampleSize, inPlace=True )
+    return inputImageCleaned
+
+def _gaussianRadius( sigma ):
+    """
+        Kernel radius of sp.ndimage.gaussian_filter (truncate=4.0)
+    """
+    return int( 4.0 * float( sigma ) + 0.5 )
+
+def _tileSlices( shape, tileSize ):
+    """
+        Slices of the tiles (tileSize along each axis) that cover shape
+    """
+    if np.isscalar( tileSize ):
+        tileSize = ( tileSize, ) * len( shape )
+    starts = [ range( 0, n, t ) for n, t in zip( shape, tileSize ) ]
+    for corner in itertools.product( *starts ):
+        yield tuple( slice( c, min( c+t, n ) )
+            for c, t, n in zip( corner, tileSize, shape ) )
+
+def _haloSlices( tile, shape, halo ):
+    """
+        Grows the tile by halo (clipped to shape) and returns the grown
+        slices and the slices of the tile within the grown block
+    """
+    grown = tuple( slice( max( s.start-halo, 0 ), min( s.stop+halo, n ) )
+        for s, n in zip( tile, shape ) )
+    inner = tuple( slice( s.start-g.start, s.stop-g.start )
+        for s, g in zip( tile, grown ) )
+    return grown, inner
+
+def _mapTiles( fun, tiles, nThreads ):
+    if nThreads > 1:
+        pool = ThreadPool( nThreads )
+        try:
+            pool.map( fun, tiles )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for tile in tiles:
+            fun( tile )
+
+def removeBackgroundTiled( inputImage, backgroundScale, noiseSize=1,
+                           output=None, tileSize=256, nThreads=1,
+                           sampleSize=None, sampleMethod='strided',
+                           seed=None, dtype=None ):
+    """
+        Tiled version of removeBackground for large (e.g., memory-mapped)
+        images. The image is processed in tiles of tileSize, each read with
+        a halo that covers the support of both Gaussian filters, so the
+        result equals that of removeBackground. output is an array (e.g.,
+        a np.memmap), a filename for a new .npy memmap, or None.
+        Tiles are processed by nThreads threads. The FWHM scaling is
+        estimated in a second pass over the output, from sampleSize values
+        if given, which is recommended for volumes that do not fit in memory.
+        dtype is the computation (and new output) type, as in
+        removeBackground
+    """
+    shape = inputImage.shape
+    if output is None:
+        output = np.empty( shape, dtype=float if dtype is None else dtype )
+    elif isinstance( output, str ):
+        output = np.lib.format.open_memmap( output, mode='w+',
+            dtype=float if dtype is None else dtype, shape=shape )
+
+    noiseScale = noiseSize/2
+    backgroundHalo = _gaussianRadius( backgroundScale )
+    noiseHalo = _gaussianRadius( noiseScale/3 )
+
+    def cleanTile( tile ):
+        backgroundBlock, tileInner = _haloSlices( tile, shape,
+            backgroundHalo )
+        block, backgroundInner = _haloSlices( backgroundBlock, shape,
+            noiseHalo )
+        smoothedImage = removeNoise( inputImage[block], noiseScale,
+            dtype=dtype )[backgroundInner]
+        if dtype is None:
+            smoothedImage = smoothedImage.astype( float )
+        backgroundImage = findBackground( smoothedImage, backgroundScale )
+        output[tile] = divideImages( smoothedImage[tileInner],
+            backgroundImage[tileInner] )
+
+    tiles = list( _tileSlices( shape, tileSize ) )
+    _mapTiles( cleanTile, tiles, nThreads )
+
+    meanV, stdDevV = _estimateFullWidthHalfMax( output, False, sampleSize,
+        sampleMethod, seed )
+
+    def scaleTile( tile ):
+        _scaleInPlace( output[tile], meanV, stdDevV, 3 )
+
+    _mapTiles( scaleTile, tiles, nThreads )
+    if isinstance( output, np.memmap ):
+        output.flush()
+    return output
+
+def _frameSigma( frames, sigma ):
+    """
+        Per-axis sigma that smooths each frame of a (frames, ...) stack
+    """
+    return ( 0, ) + ( sigma, ) * ( frames.ndim-1 )
+
+def _frameStructure( ndim, connectivity ):
+    """
+        Structuring element of a (frames, ...) stack that connects pixels
+        within the same frame only
+    """
+    structure = np.zeros( ( 3, ) * ndim, dtype=bool )
+    structure[1] = sp.ndimage.generate_binary_structure( ndim-1,
+        connectivity )
+    return structure
+
+def _frameChunkJob( job ):
+    function, chunk, args, kwargs = job
+    return function( chunk, *args, **kwargs )
 
-def removeBackground( inputImage, backgroundScale, noiseSize=1 ):
-    smoothedImage = removeNoise( inputImage, noiseSize/2 ).astype( float )
-    backgroundImage = findBackground( smoothedImage,
-        backgroundScale ).astype( float )
-    inputImageCleaned = divideImages( smoothedImage, backgroundImage )
-    inputImageCleaned = scaleUsingFullWidthHalfMax( inputImageCleaned, 3 )
+def _mapFrameChunks( function, frames, args, kwargs, nProcesses, chunkSize,
+                     out=None ):
+    """
+        Applies function to chunks of chunkSize frames in a pool of
+        nProcesses processes and stacks the results (in out, if given)
+    """
+    jobs = ( ( function, frames[i:i+chunkSize], args, kwargs )
+        for i in range( 0, len( frames ), chunkSize ) )
+    pool = Pool( nProcesses )
+    try:
+        # Copy each chunk into out as soon as it is done
+        for k, result in enumerate( pool.imap( _frameChunkJob, jobs ) ):
+            i = k * chunkSize
+            if out is None:
+                out = np.empty( ( len( frames ), ) + result.shape[1:],
+                    dtype=result.dtype )
+            out[i:i+len( result )] = result
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+def gaussianFilterFrames( frames, sigma, out=None, want_highpass=True,
+                          dtype=None ):
+    """
+        gaussianFilter applied to each frame of a (frames, H, W) stack
+    """
+    return gaussianFilter( frames, _frameSigma( frames, sigma ), out=out,
+        want_highpass=want_highpass, dtype=dtype )
+
+def removeBackgroundFrames( frames, backgroundScale, noiseSize=1,
+                            sampleSize=None, out=None, dtype=None,
+                            nProcesses=1, chunkSize=64 ):
+    """
+        removeBackground applied to each frame of a (frames, H, W) stack
+        The filters run on the whole stack (or on chunks of chunkSize
+        frames in nProcesses processes); the FWHM scaling is per frame
+    """
+    frames = np.asarray( frames )
+    if nProcesses > 1:
+        return _mapFrameChunks( removeBackgroundFrames, frames,
+            ( backgroundScale, noiseSize, sampleSize, None, dtype ), {},
+            nProcesses, chunkSize, out )
+
+    smoothedImage, tmp = gaussianFilterFrames( frames, ( noiseSize/2 )/3,
+        out=out, want_highpass=False, dtype=dtype )
+    if out is None and dtype is None:
+        smoothedImage = smoothedImage.astype( float )
+    backgroundImage, tmp = gaussianFilterFrames( smoothedImage,
+        backgroundScale, want_highpass=False )
+    inputImageCleaned = divideImages( smoothedImage, backgroundImage,
+        out=smoothedImage )
+    for frame in inputImageCleaned:
+        scaleUsingFullWidthHalfMax( frame, 3, sampleSize=sampleSize,
+            inPlace=True )
     return inputImageCleaned
+
+def _removeSmallSizesFrames( frames, minSize, structure ):
+    """
+        removeSmallSizes applied to each frame of a (frames, ...) stack
+    """
+    labelImage, num_objects = sp.ndimage.label( frames, structure )
+
+    if frames.dtype == bool:
+        sizes = np.bincount( labelImage.ravel() )
+    else:
+        # Weights relative to the maximum of each frame
+        maxima = frames.reshape( len( frames ), -1 ).max( axis=1 )
+        maxima[maxima == 0] = 1
+        weights = frames / maxima.reshape( ( -1, ) + ( 1, ) *
+            ( frames.ndim-1 ) )
+        sizes = np.bincount( labelImage.ravel(), weights=weights.ravel() )
+
+    keep = sizes >= minSize
+    keep[0] = False
+    return keep[labelImage]
+
+def removeSmallRegionBlobsFrames( frames, regionThreshold, nProcesses=1,
+                                  chunkSize=64 ):
+    """
+        removeSmallRegionBlobs applied to each frame of a (frames, H, W)
+        stack, by labeling the stack without connections across frames
+    """
+    frames = np.asarray( frames )
+    if nProcesses > 1:
+        return _mapFrameChunks( removeSmallRegionBlobsFrames, frames,
+            ( regionThreshold, ), {}, nProcesses, chunkSize )
+
+    prunedImage1 = _removeSmallSizesFrames( frames, regionThreshold,
+        _frameStructure( frames.ndim, frames.ndim-1 ) )
+
+    prunedImage2 = _removeSmallSizesFrames( prunedImage1, regionThreshold,
+        _frameStructure( frames.ndim, 1 ) )
+
+    return prunedImage2
+
+class PreprocessingPipeline( object ):
+    """
+        removeBackground -> threshold -> removeSmallRegionBlobs -> cropImage
+        for a stream of frames (e.g., of an ultrasound video)
+
+        The stages are fused: the frame is cleaned in float buffers (image
+        and background) that are kept between frames (of dtype, default
+        float64, see removeBackground), thresholding directly yields the binary mask
+        instead of a lowVal/highVal image, and the blob removal labels into
+        a kept label buffer. Cropping (cropImage on the binary image) is
+        skipped if roiMinThreshold is None. The cumulative time of each
+        stage is kept in timings.
+    """
+
+    def __init__( self, backgroundScale, edgeThreshold, regionThreshold,
+                  noiseSize=1, roiMinThreshold=None, roiMaxThreshold=None,
+                  sampleSize=None, dtype=None ):
+        self.backgroundScale = backgroundScale
+        self.edgeThreshold = edgeThreshold
+        self.regionThreshold = regionThreshold
+        self.noiseSize = noiseSize
+        self.roiMinThreshold = roiMinThreshold
+        self.roiMaxThreshold = roiMaxThreshold
+        self.sampleSize = sampleSize
+        self.dtype = float if dtype is None else dtype
+
+        self.frames = 0
+        self.timings = OrderedDict( ( stage, 0.0 ) for stage in
+            ( 'removeBackground', 'threshold', 'removeSmallRegionBlobs',
+              'cropImage' ) )
+        self._shape = None
+
+    def _allocate( self, shape ):
+        self._cleaned = np.empty( shape, dtype=self.dtype )
+        self._background = np.empty( shape, dtype=self.dtype )
+        self._mask = np.empty( shape, dtype=bool )
+        self._pruned = np.empty( shape, dtype=bool )
+        self._labels = np.empty( shape, dtype=np.int32 )
+        self._shape = shape
+
+    def _removeSmallSizes( self, mask, structure=None, out=None ):
+        # removeSmallSizes on a binary mask, labeling into the label buffer
+        if not mask.any():
+            return mask
+        sp.ndimage.label( mask, structure, output=self._labels )
+        keep = np.bincount( self._labels.ravel() ) >= self.regionThreshold
+        keep[0] = False
+        return np.take( keep, self._labels, out=out )
+
+    def process( self, frame ):
+        """
+            Runs all stages on a frame. Returns the binary image (cropped,
+            if roiMinThreshold is given) and the crop coordinates of
+            cropImage (None if not cropping)
+        """
+        frame = np.asarray( frame )
+        if frame.shape != self._shape:
+            self._allocate( frame.shape )
+
+        t0 = time.time()
+        cleaned = removeBackground( frame, self.backgroundScale,
+            self.noiseSize, sampleSize=self.sampleSize, out=self._cleaned,
+            backgroundOut=self._background )
+
+        t1 = time.time()
+        # threshold( cleaned, edgeThreshold ) > 0
+        mask = np.greater( cleaned, self.edgeThreshold, out=self._mask )
+        if 255 < self.edgeThreshold + 0.00000000001:
+            mask.fill( False )
+
+        t2 = time.time()
+        fullyConnected = sp.ndimage.generate_binary_structure( mask.ndim,
+            mask.ndim )
+        pruned = self._removeSmallSizes( mask, fullyConnected,
+            out=self._pruned )
+        pruned = self._removeSmallSizes( pruned )
+        if pruned is self._pruned or pruned is self._mask:
+            # The result must outlive the buffers
+            pruned = pruned.copy()
+
+        t3 = time.time()
+        minCoord = maxCoord = None
+        if self.roiMinThreshold is not None:
+            pruned, minCoord, maxCoord = cropImage( pruned,
+                self.roiMinThreshold, self.roiMaxThreshold )
+        t4 = time.time()
+
+        self.frames += 1
+        for stage, elapsed in zip( self.timings,
+                                   ( t1-t0, t2-t1, t3-t2, t4-t3 ) ):
+            self.timings[stage] += elapsed
+
+        return pruned, minCoord, maxCoord
+
+    def stageTimes( self ):
+        """
+            Mean time per frame (in seconds) of each stage
+        """
+        return OrderedDict( ( stage, elapsed / max( self.frames, 1 ) )
+            for stage, elapsed in self.timings.items() )